@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ISV pipeline on synthetic CNVs
+
+Times loading of databases, annotate, predict, shap_values, ISV.waterfall and the command line tool for each
+requested number of CNVs and writes throughput, latency percentiles and peak memory as JSON, so that results can be
+compared between versions, e.g.
+
+    python benchmark.py -n 100 10000 1000000 -o benchmark.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numba as nb
+import numpy as np
+import pandas as pd
+
+from isv import ISV, annotate, predict, shap_values, load_databases, clear_databases, preload
+from isv.config import settings
+from isv.scripts.constants import CHROMOSOME_LENGTHS
+
+# mean and standard deviation of log CNV lengths in the training data, and the range of lengths
+SIZE_DISTRIBUTIONS = {"DEL": (11.17, 2.28), "DUP": (11.78, 1.63)}
+MIN_SIZE, MAX_SIZE = 1000, 5000000
+
+STAGES = ["load_databases", "annotate", "predict", "shap_values", "waterfall", "cli"]
+
+
+def synthetic_cnvs(n: int, seed: int = 1618, del_fraction: float = 0.5):
+    """Generate random CNVs
+
+    Chromosomes are drawn proportionally to their length and CNV lengths from log-normal distributions fitted to
+    deletions and duplications of the training data
+
+    :param n: number of CNVs
+    :param seed: random seed
+    :param del_fraction: fraction of deletions
+
+    :return: pandas dataframe with chromosome, start, end and cnv_type columns
+    """
+    rng = np.random.default_rng(seed)
+
+    names = np.array(list(CHROMOSOME_LENGTHS.keys()))
+    lengths = np.array(list(CHROMOSOME_LENGTHS.values()), dtype=np.int64)
+    chrom_ind = rng.choice(len(names), size=n, p=lengths / lengths.sum())
+
+    cnv_type = np.where(rng.random(n) < del_fraction, "DEL", "DUP")
+
+    size = np.empty(n, dtype=np.int64)
+    for t, (mean, sd) in SIZE_DISTRIBUTIONS.items():
+        ind = cnv_type == t
+        size[ind] = np.clip(np.exp(rng.normal(mean, sd, ind.sum())), MIN_SIZE, MAX_SIZE).astype(np.int64)
+
+    start = (rng.random(n) * (lengths[chrom_ind] - size)).astype(np.int64) + 1
+
+    return pd.DataFrame({"chromosome": names[chrom_ind], "start": start, "end": start + size - 1,
+                         "cnv_type": cnv_type})
+
+
+def summarize(stage, n_cnvs, seconds, peak_memory):
+    """Summarize repeated measurements of a stage
+
+    :param stage: name of the stage
+    :param n_cnvs: number of CNVs processed by each call
+    :param seconds: list of elapsed seconds of each call
+    :param peak_memory: peak memory in bytes
+
+    :return: dictionary
+    """
+    seconds = np.array(seconds)
+    return {
+        "stage": stage,
+        "n_cnvs": n_cnvs,
+        "repeats": len(seconds),
+        "seconds": {"mean": float(seconds.mean()), "min": float(seconds.min()),
+                    **{f"p{q}": float(np.percentile(seconds, q)) for q in [50, 95, 99]}},
+        "cnvs_per_second": n_cnvs / float(np.median(seconds)),
+        "peak_memory_mb": peak_memory / 2 ** 20,
+    }
+
+
+def measure(fun, repeats, setup=None):
+    """Time repeated calls of a function, and measure its peak memory in a separate traced call
+
+    Memory tracing slows down allocations, so timed calls are not traced
+
+    :param fun: function without arguments
+    :param repeats: number of timed calls
+    :param setup: function called before each call, excluded from timing
+
+    :return: tuple (list of elapsed seconds, peak traced memory in bytes)
+    """
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fun()
+        seconds.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fun()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak
+
+
+def run_cli(cnvs, repeats, shap=False):
+    """Time the command line tool end to end
+
+    :param cnvs: dataframe of CNVs
+    :param repeats: number of runs
+    :param shap: whether shap values should be calculated
+
+    :return: tuple (list of elapsed seconds, peak resident memory of the process in bytes)
+    """
+    cmd = os.path.join(os.path.dirname(os.path.abspath(__file__)), "isv_cmd.py")
+    seconds, peak = [], 0
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "cnvs.tsv")
+        cnvs.to_csv(input_path, sep="\t", index=False)
+
+        args = [sys.executable, cmd, "-i", input_path, "-o", os.path.join(tmp, "out.tsv"), "-p"]
+        if shap:
+            args.append("-sv")
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            p = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+            _, status, usage = os.wait4(p.pid, 0)
+            seconds.append(time.perf_counter() - start)
+            assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, "isv_cmd.py failed"
+            # ru_maxrss is in kilobytes
+            peak = max(peak, usage.ru_maxrss * 1024)
+
+    return seconds, peak
+
+
+def benchmark(sizes, stages=None, repeats: int = 3, max_shap_size: int = 10000, shap_background: str = None,
+              seed: int = 1618, shap_methods=None):
+    """Benchmark pipeline stages
+
+    :param sizes: list of numbers of CNVs
+    :param stages: list of stages (see STAGES). Defaults to all stages
+    :param repeats: number of timed calls of each stage
+    :param max_shap_size: larger inputs are not used for shap_values, which is much slower than other stages
+    :param shap_background: background dataset of SHAP values, either "full" or "sample"
+    :param seed: random seed of synthetic CNVs
+    :param shap_methods: list of SHAP methods ("exact", "xgboost", "approximate"). Defaults to ["exact"]
+
+    :return: dictionary with environment information and a list of results
+    """
+    if stages is None:
+        stages = STAGES
+    if shap_methods is None:
+        shap_methods = ["exact"]
+    results = []
+
+    if "load_databases" in stages:
+        seconds, peak = measure(load_databases, repeats, setup=clear_databases)
+        results.append(summarize("load_databases", 0, seconds, peak))
+
+    # load databases and models, and compile kernels, so that following stages measure steady state
+    preload(shap="shap_values" in stages)
+    annotate(synthetic_cnvs(2, seed))
+
+    for n in sizes:
+        cnvs = synthetic_cnvs(n, seed)
+        annotated = annotate(cnvs.copy())
+
+        if "annotate" in stages:
+            seconds, peak = measure(lambda: annotate(cnvs.copy()), repeats)
+            results.append(summarize("annotate", n, seconds, peak))
+
+        if "predict" in stages:
+            seconds, peak = measure(lambda: predict(annotated), repeats)
+            results.append(summarize("predict", n, seconds, peak))
+
+        if "shap_values" in stages and n <= max_shap_size:
+            for method in shap_methods:
+                seconds, peak = measure(lambda: shap_values(annotated, background=shap_background, method=method),
+                                        repeats)
+                results.append({**summarize("shap_values", n, seconds, peak), "shap_method": method})
+
+        if "cli" in stages:
+            seconds, peak = run_cli(cnvs, repeats)
+            results.append(summarize("cli", n, seconds, peak))
+
+    if "waterfall" in stages:
+        cnv_isv = ISV(synthetic_cnvs(1, seed))
+        seconds, peak = measure(lambda: cnv_isv.waterfall(0, background=shap_background, return_fig=True), repeats)
+        results.append(summarize("waterfall", 1, seconds, peak))
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numba_threads": nb.config.NUMBA_NUM_THREADS,
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "shap_background": shap_background if shap_background is not None else settings.shap_background,
+        "seed": seed,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark of the ISV pipeline on synthetic CNVs")
+
+    parser.add_argument("-n", "--sizes", required=False, type=int, nargs="+", default=[100, 10000, 1000000],
+                        help="numbers of synthetic CNVs (up to 10000000)")
+    parser.add_argument("-s", "--stages", required=False, nargs="+", choices=STAGES, default=STAGES,
+                        help="stages to benchmark")
+    parser.add_argument("-r", "--repeats", required=False, type=int, default=3,
+                        help="number of timed calls of each stage")
+    parser.add_argument("--max-shap-size", required=False, type=int, default=10000,
+                        help="largest number of CNVs used for shap_values")
+    parser.add_argument("--shap-background", required=False, choices=["full", "sample"], default=None,
+                        help="background dataset of SHAP values")
+    parser.add_argument("--shap-methods", required=False, nargs="+", choices=["exact", "xgboost", "approximate"],
+                        default=["exact"], help="SHAP methods to benchmark")
+    parser.add_argument("--seed", required=False, type=int, default=1618, help="random seed of synthetic CNVs")
+    parser.add_argument("-o", "--output", required=False, type=str, default=None,
+                        help="where the json results will be saved. Printed if not set")
+
+    args = parser.parse_args()
+
+    res = benchmark(args.sizes, args.stages, args.repeats, args.max_shap_size, args.shap_background, args.seed,
+                    args.shap_methods)
+
+    if args.output is None:
+        print(json.dumps(res, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=2)
+        print(f"Results saved to {args.output}")
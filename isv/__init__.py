@@ -1,12 +1,23 @@
 from .predict import predict
-from .shap_vals import shap_values
-from .annotate import annotate
+from .shap_vals import shap_values, load_explainer, clear_explainers
+from .annotate import annotate, load_databases, clear_databases
 from .isv import ISV
+from .sensitivity import breakpoint_sensitivity
+from .scripts.open_model import load_model, clear_models
+from .scripts.tree_ensemble import load_tree_ensemble, clear_tree_ensembles
+from .config import settings
+from .scripts.prepare_df import load_scaler, clear_scalers
+from .scripts.result_cache import enable_result_cache, disable_result_cache
+from .scripts.profiling import profile, add_callback, remove_callback
+from .scripts.parallel import shutdown_pool
 
+import numpy as np
 import pandas as pd
 
 
-def isv(cnvs, proba: bool = True, shap: bool = False, threshold: float = 0.95):
+def isv(cnvs, proba: bool = True, shap: bool = False, threshold: float = 0.95, shap_background: str = None,
+        n_jobs: int = 1, backend: str = None, shap_proba_range=None, shap_method: str = None,
+        shap_output: str = "probability"):
     """Predict pathogenicity, and optionally calculate shap values of CNVs with this simple wrapper class
 
     :param cnvs: a list, np.array or pandas dataframe with 4 columns representing chromosome (eg, chr3), \
@@ -15,13 +26,72 @@ def isv(cnvs, proba: bool = True, shap: bool = False, threshold: float = 0.95):
     :param shap: whether probabilities should be calculated
     :param threshold: probability threshold for classifying CNVs into three classes: Pathogenic (>= threshold), \
     Uncertain significance ((1-threshold, threshold)) or Benign (<= 1 - threshold)
+    :param shap_background: background dataset of SHAP values, either "full" or "sample". See isv.shap_values
+    :param n_jobs: number of cores / processes used (-1 for all cores). See isv.ISV
+    :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
+    :param shap_proba_range: tuple (low, high), SHAP values are calculated only for CNVs with \
+    low < probability < high, e.g. (1 - threshold, threshold) for CNVs of uncertain significance
+    :param shap_method: either "exact", "xgboost" or "approximate". See isv.shap_values
+    :param shap_output: either "probability" or "log_odds". See isv.shap_values
 
     :return: pandas dataframe of results
     """
-    cnv_isv = ISV(cnvs)
-    result = cnv_isv.predict(proba, threshold)
+    cnv_isv = ISV(cnvs, n_jobs=n_jobs)
+    result = cnv_isv.predict(proba, threshold, backend)
     if shap:
-        temp = cnv_isv.shap()
-        result = pd.concat([result, temp.iloc[:, 4:]], axis=1)
+        cnv_indexes = None
+        if shap_proba_range is not None and proba:
+            # reuse predictions instead of predicting again
+            low, high = shap_proba_range
+            cnv_indexes = np.where((result.ISV > low) & (result.ISV < high))[0]
+            shap_proba_range = None
+        sv = cnv_isv.shap(cnv_isv.annotated, background=shap_background, cnv_indexes=cnv_indexes,
+                          proba_range=shap_proba_range, method=shap_method, output=shap_output)
+        result = pd.concat([result, sv], axis=1, copy=False)
 
     return result
+
+
+def preload(shap: bool = False):
+    """Load annotation databases, models and scalers into the process wide cache
+
+    Useful in long running processes, so that the first call to annotate or predict does not pay the loading cost
+
+    :param shap: whether SHAP explainers (with settings.shap_background) should be created as well
+    """
+    load_databases()
+    for cnv_type in ["loss", "gain"]:
+        if settings.predict_backend == "numba":
+            load_tree_ensemble(cnv_type)
+        else:
+            load_model(cnv_type)
+        load_scaler(cnv_type)
+        if shap and settings.shap_method == "approximate":
+            load_tree_ensemble(cnv_type)
+        elif shap and settings.shap_method == "xgboost":
+            load_model(cnv_type)
+        elif shap:
+            load_explainer(cnv_type)
+
+
+def clear_cache():
+    """Free all cached annotation databases, models, scalers and explainers, and stop worker processes holding
+    their copies. They will be reloaded on next use"""
+    shutdown_pool()
+    clear_databases()
+    clear_models()
+    clear_tree_ensembles()
+    clear_scalers()
+    clear_explainers()
+
+
+def warmup(shap: bool = False):
+    """Compile annotation kernels and load databases, models and scalers
+
+    Compiled kernels are cached on disk, so only the first warmup after installation pays the compilation cost.
+    Call it when a worker starts, so that its first request is as fast as the following ones
+
+    :param shap: whether SHAP explainers should be created and exercised as well
+    """
+    preload(shap=shap)
+    isv([["chr1", 1, 2, "DEL"], ["chr1", 1, 2, "DUP"]], shap=shap)
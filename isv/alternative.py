@@ -5,24 +5,27 @@ import numpy as np
 import pandas as pd
 import xgboost as xgb
 
-from isv import annotate
 from isv.scripts.constants import GAIN_ATTRIBUTES, LOSS_ATTRIBUTES
+from isv.scripts.feature_store import scaled_features, enable_feature_store, disable_feature_store
 from isv.scripts.helpers import check_cnvs_obj
-from isv.scripts.prepare_df import prepare
 
 
-def alternative_data(cnvs: Union[list, np.ndarray, pd.DataFrame], labels: Union[list, np.ndarray],
-                     extra_columns: Union[pd.DataFrame, dict],
-                     cnv_type: str) -> xgb.DMatrix:
-    """Prepare dataset
+def alternative_arrays(cnvs: Union[list, np.ndarray, pd.DataFrame], labels: Union[list, np.ndarray],
+                       extra_columns: Union[pd.DataFrame, dict],
+                       cnv_type: str):
+    """Prepare dataset as arrays
 
     In the first step annotate and scale cnvs in bed format by ISV.
     Then add columns specified in a dictionary or dataframe.
 
+    Annotated and scaled features are reused from the feature store if it is enabled \
+    (see enable_feature_store), so only extra columns are added on repeated calls.
+
     :param cnvs: cnvs specified in a bed format
+    :param labels: labels of cnvs
     :param extra_columns: columns to be added to the dataset
     :param cnv_type: either DUP or DEL
-    :return: pandas dataframe
+    :return: tuple (float32 feature matrix, labels, feature names)
     """
     cnvs = check_cnvs_obj(cnvs)
 
@@ -40,16 +43,57 @@ def alternative_data(cnvs: Union[list, np.ndarray, pd.DataFrame], labels: Union[
     assert len(cnv_type_set) == 1
     assert cnv_type in cnv_type_set
 
-    annotated = annotate(cnvs)
     attributes = [LOSS_ATTRIBUTES, GAIN_ATTRIBUTES][cnv_type == 'DUP']
-    annotated_scaled = pd.DataFrame(prepare(annotated, cnv_type), columns=attributes)
+    annotated_scaled = scaled_features(cnvs, ['loss', 'gain'][cnv_type == 'DUP'])
+    assert len(extra_columns) == len(annotated_scaled), "extra_columns should have one row per cnv"
 
-    # create dmat
-    X = pd.concat([annotated_scaled, extra_columns], axis=1)
+    # a single float32 matrix, which xgboost uses without conversion
+    X = np.empty((len(annotated_scaled), len(attributes) + extra_columns.shape[1]), dtype=np.float32)
+    X[:, :len(attributes)] = annotated_scaled
+    X[:, len(attributes):] = extra_columns.values
     y = np.array(labels).flatten()
-    assert y.shape[0] == labels.shape[0]
+    assert y.shape[0] == len(annotated_scaled)
+
+    return X, y, list(attributes) + [str(c) for c in extra_columns.columns]
+
+
+def alternative_data(cnvs: Union[list, np.ndarray, pd.DataFrame], labels: Union[list, np.ndarray],
+                     extra_columns: Union[pd.DataFrame, dict],
+                     cnv_type: str) -> xgb.DMatrix:
+    """Prepare dataset
+
+    In the first step annotate and scale cnvs in bed format by ISV.
+    Then add columns specified in a dictionary or dataframe. See alternative_arrays
+
+    :param cnvs: cnvs specified in a bed format
+    :param labels: labels of cnvs
+    :param extra_columns: columns to be added to the dataset
+    :param cnv_type: either DUP or DEL
+    :return: xgboost DMatrix
+    """
+    X, y, feature_names = alternative_arrays(cnvs, labels, extra_columns, cnv_type)
+    return xgb.DMatrix(X, y, feature_names=feature_names)
 
-    return xgb.DMatrix(X, y)
+
+def default_params(labels):
+    """ISV model parameters
+
+    :param labels: training labels
+    :return: dictionary of xgboost parameters
+    """
+    train_Y = np.array(labels)
+    return {
+        'max_depth': 8,
+        'eta': 0.3,
+        'gamma': 1,
+        'subsample': 1,
+        'lambda': 0.1,
+        'colsample_bytree': 0.8,
+        'scale_pos_weight': np.sqrt(sum(train_Y == 0) / sum(train_Y == 1)),
+        'seed': 1618,
+        'nthread': 4,
+        'objective': 'binary:logistic',
+        'eval_metric': 'logloss'}
 
 
 def alternative_model(train_dmat: xgb.DMatrix,
@@ -65,22 +109,164 @@ def alternative_model(train_dmat: xgb.DMatrix,
     :param verbose_eval: verbosity
     :return: xgboost model
     """
-    train_Y = np.array(train_dmat.get_label())
     if params is None:
-        params = {
-            'max_depth': 8,
-            'eta': 0.3,
-            'gamma': 1,
-            'subsample': 1,
-            'lambda': 0.1,
-            'colsample_bytree': 0.8,
-            'scale_pos_weight': np.sqrt(sum(train_Y == 0) / sum(train_Y == 1)),
-            'seed': 1618,
-            'nthread': 4,
-            'objective': 'binary:logistic',
-            'eval_metric': 'logloss'}
+        params = default_params(train_dmat.get_label())
 
     model = xgb.train(params, train_dmat, num_boost_round=num_boost_round, early_stopping_rounds=early_stopping_rounds,
                       evals=[(train_dmat, 'train'), (val_dmat, 'validation')], verbose_eval=verbose_eval)
 
     return model
+
+
+# metrics which are better when higher, others are minimized
+MAXIMIZED_METRICS = ('auc', 'aucpr', 'map', 'ndcg', 'pre')
+
+_search_data = None
+
+
+def parameter_candidates(space: dict, n_iter: int = None, seed: int = 1618):
+    """Parameter combinations of a search space
+
+    :param space: dictionary of parameter values. Values are lists, or distributions with a scipy like \
+    rvs(random_state=...) method (random search only)
+    :param n_iter: number of random combinations. If None, all combinations of the grid are returned
+    :param seed: random seed
+    :return: list of dictionaries
+    """
+    if n_iter is None:
+        grid = pd.MultiIndex.from_product(list(space.values()), names=list(space.keys()))
+        return [dict(zip(space.keys(), values)) for values in grid]
+
+    rng = np.random.default_rng(seed)
+    return [{name: values.rvs(random_state=rng) if hasattr(values, 'rvs') else values[rng.integers(len(values))]
+             for name, values in space.items()} for _ in range(n_iter)]
+
+
+def eval_metric(params: dict):
+    """Metric used for early stopping and scores of trials, the last one if there are more"""
+    metric = params['eval_metric']
+    return metric if isinstance(metric, str) else metric[-1]
+
+
+def _init_search(train_data, val_data):
+    global _search_data
+    _search_data = tuple(None if data is None else xgb.DMatrix(data[0], data[1], feature_names=data[2])
+                         for data in [train_data, val_data])
+
+
+def _evaluate(trial):
+    """Train a single trial
+
+    :param trial: tuple (trial number, parameters, number of boosting rounds, early stopping rounds, number of folds)
+    :return: dictionary with the trial number, best score, best iteration and seconds
+    """
+    import time
+
+    i, params, num_boost_round, early_stopping_rounds, n_folds = trial
+    train_dmat, val_dmat = _search_data
+
+    start = time.perf_counter()
+    if n_folds is not None:
+        res = xgb.cv(params, train_dmat, num_boost_round=num_boost_round, nfold=n_folds, stratified=True,
+                     early_stopping_rounds=early_stopping_rounds, seed=params.get('seed', 0))
+        # with early stopping, rows end at the best iteration
+        score, best_iteration = res.iloc[-1][f"test-{eval_metric(params)}-mean"], len(res) - 1
+    else:
+        model = alternative_model(train_dmat, val_dmat, params, num_boost_round, early_stopping_rounds)
+        if early_stopping_rounds is not None:
+            score, best_iteration = model.best_score, model.best_iteration
+        else:
+            # "[i]\tvalidation-metric:score", the last metric is the one used for early stopping
+            score, best_iteration = model.eval(val_dmat, 'validation').split(':')[-1], num_boost_round - 1
+
+    return {'trial': i, 'score': float(score), 'best_iteration': int(best_iteration),
+            'seconds': time.perf_counter() - start}
+
+
+def _run_trials(trials, pool):
+    if pool is None:
+        return [_evaluate(t) for t in trials]
+    # trials differ in cost, hand them out one by one
+    return list(pool.imap(_evaluate, trials, chunksize=1))
+
+
+def parameter_search(train_data: tuple, val_data: tuple = None, space: dict = None, n_iter: int = None,
+                     n_folds: int = None, params: dict = None, num_boost_round: int = 100,
+                     early_stopping_rounds: int = 15, prune_rounds: int = None, prune_quantile: float = 0.5,
+                     n_jobs: int = 1, nthread: int = None, seed: int = 1618):
+    """Grid or random search of xgboost parameters, with k-fold cross validation or a validation dataset
+
+    Trials run in a pool of n_jobs processes, each training with nthread threads, so that cores are neither idle \
+    nor oversubscribed. Trials are trained as in alternative_model, with early stopping on the validation dataset \
+    (or on held out folds).
+
+    With prune_rounds, all trials are first trained for prune_rounds boosting rounds. Only trials whose score is \
+    better than the prune_quantile quantile of these scores are then trained to num_boost_round, the rest is \
+    pruned with their short scores. Note that trials with low learning rates look worse after a few rounds than \
+    they end up, so prune_rounds should not be too small for them.
+
+    :param train_data: result of "alternative_arrays" function for train cnvs. Arrays are sent to worker \
+    processes, which build their own DMatrices
+    :param val_data: result of "alternative_arrays" function for validation cnvs. Required without n_folds
+    :param space: dictionary of parameter values, see parameter_candidates
+    :param n_iter: number of random combinations. If None, the whole grid is searched
+    :param n_folds: number of cross validation folds of train_data. If None, val_data is used
+    :param params: parameters shared by all trials. If not set, ISV parameters are used
+    :param num_boost_round: max number of boosting rounds
+    :param early_stopping_rounds: early stopping rounds
+    :param prune_rounds: number of boosting rounds after which hopeless trials are pruned. If None, no trials are pruned
+    :param prune_quantile: quantile of short scores, trials with worse scores are pruned
+    :param n_jobs: number of processes (-1 for all cores)
+    :param nthread: number of xgboost threads of each process. Defaults to cores divided by processes
+    :param seed: random seed of random search
+    :return: pandas dataframe with parameters, score (of eval_metric), best iteration, seconds and pruned columns \
+    of trials, best trials first
+    """
+    import os
+    from isv.scripts.parallel import n_processes, get_context
+    global _search_data
+
+    assert n_folds is not None or val_data is not None, "either val_data or n_folds has to be set"
+
+    candidates = parameter_candidates(space or {}, n_iter, seed)
+    n_jobs = min(n_processes(n_jobs), len(candidates))
+    if nthread is None:
+        nthread = max(os.cpu_count() // n_jobs, 1)
+
+    base = default_params(train_data[1]) if params is None else dict(params)
+    candidates = [{**base, **c, 'nthread': nthread} for c in candidates]
+    maximize = eval_metric(candidates[0]).startswith(MAXIMIZED_METRICS)
+
+    def trials(ind, rounds):
+        return [(i, candidates[i], rounds, early_stopping_rounds, n_folds) for i in ind]
+
+    pool = None
+    if n_jobs > 1:
+        pool = get_context().Pool(n_jobs, initializer=_init_search, initargs=(train_data, val_data))
+    else:
+        _init_search(train_data, val_data)
+
+    try:
+        ind = list(range(len(candidates)))
+        results, short = {}, {}
+        if prune_rounds is not None and prune_rounds < num_boost_round:
+            short = {r['trial']: r for r in _run_trials(trials(ind, prune_rounds), pool)}
+            scores = np.array([short[i]['score'] for i in ind])
+            cutoff = np.quantile(scores, 1 - prune_quantile if maximize else prune_quantile)
+            ind = [i for i in ind if (short[i]['score'] >= cutoff if maximize else short[i]['score'] <= cutoff)]
+            results = {i: {**r, 'pruned': True} for i, r in short.items() if i not in ind}
+
+        for r in _run_trials(trials(ind, num_boost_round), pool):
+            if r['trial'] in short:
+                # seconds spent before pruning count as well
+                r['seconds'] += short[r['trial']]['seconds']
+            results[r['trial']] = {**r, 'pruned': False}
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _search_data = None
+
+    res = pd.DataFrame([{**{k: candidates[i][k] for k in (space or {})}, **results[i]} for i in sorted(results)])
+    res = res.sort_values(['pruned', 'score'], ascending=[True, not maximize], kind='stable')
+    return res.reset_index(drop=True)
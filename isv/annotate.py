@@ -6,18 +6,35 @@ import pandas as pd
 import os
 import gzip
 import json
-import time
+import threading
 
 from isv.config import settings
+from isv.scripts.interval_index import PLACEHOLDER, build_index, open_index, IntervalIndex, \
+    count_overlaps_into, sweep_overlaps_into
+from isv.scripts import profiling
+from isv.scripts.result_cache import cached_rows
+from isv.scripts.helpers import is_arrow, from_arrow
+
+# annotation databases keyed by data directory
+_databases = {}
+_databases_lock = threading.Lock()
 
 
 def open_data(f):
     """Open preprocessed data
 
+    Binary (.npy) databases are memory mapped, gzipped json databases are read into memory.
+
     :param f: filepath
 
     :return: python dictionary of numpy arrays
     """
+    if f.endswith(".npy"):
+        arr = np.load(f, mmap_mode="r")
+        # rows are grouped by chromosome -> per chromosome views of the memory mapped array
+        offsets = np.searchsorted(arr[:, 0], np.arange(1, 26), side="left")
+        return {i: arr[offsets[i - 1]:offsets[i]] for i in range(1, 25)}
+
     with gzip.open(f, 'r') as g:
         temp = json.loads(g.read().decode("utf-8"))
     
@@ -29,75 +46,257 @@ def open_data(f):
     return cd
 
 
-@nb.jit(nopython=True)
-def get_el(arr, start: int, end: int):
-    """Get overlapped elements
+def save_data(f, cd):
+    """Save preprocessed data in a memory mappable binary format
+
+    All rows are stored in a single int32 .npy array, grouped and sorted by chromosome.
+    Placeholders of chromosomes without elements are dropped.
+
+    :param f: filepath (.npy)
+    :param cd: per chromosome dictionary of lists or numpy arrays
+    """
+    rows = [np.asarray(cd[i], dtype=np.int64) for i in range(1, 25)]
+    arr = np.concatenate([r for r in rows if not np.all(r == PLACEHOLDER)])
+    np.save(f, arr.astype(np.int32))
+
+
+def database_path(name):
+    """Path to a preprocessed database, preferring the binary format over gzipped json which is not newer
+
+    :param name: database name, eg. "gencode_genes"
+
+    :return: filepath
+    """
+    f = os.path.join(settings.data_dir, "preprocessed", f"{name}.npy")
+    json_f = os.path.join(settings.data_dir, "preprocessed", f"{name}.json.gz")
+    if os.path.exists(f) and not (os.path.exists(json_f) and os.path.getmtime(json_f) > os.path.getmtime(f)):
+        return f
+    return json_f
+
+
+def gencode_weights(arr):
+    """Per element weights of gencode genes: all, gene types, morbid and disease associated genes"""
+    return np.column_stack([
+        np.ones(len(arr), dtype=np.int64),
+        arr[:, 3] == settings.gene_type_dict["protein_coding"],
+        arr[:, 3] == settings.gene_type_dict["pseudogene"],
+        arr[:, 3] == settings.gene_type_dict["miRNA"],
+        arr[:, 3] == settings.gene_type_dict["lncRNA"],
+        arr[:, 3] == settings.gene_type_dict["rRNA"],
+        arr[:, 3] == settings.gene_type_dict["snRNA"],
+        arr[:, 4],  # morbid genes
+        arr[:, 5],  # disease associated genes
+    ])
+
+
+def hi_genes_weights(arr):
+    """Per element weights of haploinsufficient genes"""
+    return np.ones((len(arr), 1), dtype=np.int64)
+
+
+def hits_regions_weights(arr):
+    """Per element weights of HI and TS regions"""
+    return arr[:, 3:5]
+
 
-    :param arr: array to query
-    :param start: start position
-    :param end: end position
+def regulatory_weights(arr):
+    """Per element weights of regulatory elements: all and regulatory types"""
+    return np.column_stack([
+        np.ones(len(arr), dtype=np.int64),
+        arr[:, 3] == settings.regulatory_type_dict["enhancer"],
+        arr[:, 3] == settings.regulatory_type_dict["open_chromatin_region"],
+        arr[:, 3] == settings.regulatory_type_dict["promoter"],
+        arr[:, 3] == settings.regulatory_type_dict["promoter_flanking_region"],
+        arr[:, 3] == settings.regulatory_type_dict["CTCF_binding_site"],
+        arr[:, 3] == settings.regulatory_type_dict["TF_binding_site"],
+        arr[:, 3] == settings.regulatory_type_dict["curated"],
+    ])
 
-    :return: rows of array overlapped by start, end positions
+
+# per element weights of databases
+WEIGHTS = {
+    "gencode_genes": gencode_weights,
+    "regulatory": regulatory_weights,
+    "hi_genes": hi_genes_weights,
+    "hits_regions": hits_regions_weights,
+}
+
+
+def index_path(name):
+    """Path to the prebuilt interval index of a database (see isv.scripts.build_databases)
+
+    :param name: database name, eg. "gencode_genes"
+
+    :return: directory path
+    """
+    return os.path.join(settings.data_dir, "preprocessed", f"{name}.index")
+
+
+def load_index(name):
+    """Interval index of a database
+
+    A prebuilt index which is not older than the database is memory mapped. Otherwise the index is built from the \
+    database, which sorts and sums all of its elements in memory.
+
+    :param name: database name, eg. "gencode_genes"
+
+    :return: IntervalIndex
     """
-    return arr[np.where((arr[:, 1] <= end) & (arr[:, 2] >= start))[0]]
+    f = database_path(name)
+    path = index_path(name)
+    files = [os.path.join(path, f"{field}.npy") for field in IntervalIndex._fields]
+    if all(os.path.exists(i) and os.path.getmtime(i) >= os.path.getmtime(f) for i in files):
+        return open_index(path)
+    return build_index(open_data(f), WEIGHTS[name])
+
+
+def load_databases():
+    """Load annotation databases from settings.data_dir
+
+    Databases are loaded once and kept in a process wide cache keyed by the data directory.
+
+    :return: tuple of gencode_genes, regulatory, hi_genes and hits_regions IntervalIndexes
+    """
+    data_dir = settings.data_dir
+    with _databases_lock:
+        if data_dir not in _databases:
+            with profiling.stage("load_databases"):
+                _databases[data_dir] = tuple(load_index(name)
+                                             for name in ["gencode_genes", "regulatory", "hi_genes", "hits_regions"])
+        return _databases[data_dir]
+
+
+def clear_databases():
+    """Remove all loaded annotation databases from the cache"""
+    with _databases_lock:
+        _databases.clear()
 
 
+@nb.jit(nopython=True, cache=True)
+def annotate_cnv_into(out, chrom, start, end, gencode_genes, regulatory, hi_genes, hits_regions):
+    """Annotate a candidate CNV into a preallocated row
+
+    :param out: output array of length len(settings.attributes)
+    :param chrom: chromosome number (1-24)
+    :param start: start position on the GRCh38 assembly
+    :param end: end position on the GRCh38 assembly
+    :param gencode_genes: gencode genes IntervalIndex
+    :param regulatory: regulatory elements IntervalIndex
+    :param hi_genes: hi_genes IntervalIndex
+    :param hits_regions: hi_regions and ts regions IntervalIndex
+    """
+    # order of settings.attributes
+    j = 0
+    for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+        k = index.start_cum.shape[1]
+        count_overlaps_into(out[j:(j + k)], index, chrom, start, end)
+        j += k
+
+
+@nb.jit(nopython=True, cache=True)
 def annotate_cnv(chrom, start, end, gencode_genes, regulatory, hi_genes, hits_regions):
     """Annotate a candidate CNV
 
-    :param chrom: chromosome identifier, eg. "chr1"
+    :param chrom: chromosome number (1-24)
     :param start: start position on the GRCh38 assembly
     :param end: end position on the GRCh38 assembly
-    :param gencode_genes: preprocessed gencode genes dict
-    :param regulatory: preprocessed regulatory genes dict
-    :param hi_genes: preprocessed hi_genes genes dict
-    :param hits_regions: preprocessed hi_regions and ts regions dict
+    :param gencode_genes: gencode genes IntervalIndex
+    :param regulatory: regulatory elements IntervalIndex
+    :param hi_genes: hi_genes IntervalIndex
+    :param hits_regions: hi_regions and ts regions IntervalIndex
 
     :return: annotation
     """
-    
-    overlapped_genes = get_el(gencode_genes[chrom], start, end)
-    overlapped_regulatory = get_el(regulatory[chrom], start, end)
-    overlapped_hi_genes = get_el(hi_genes[chrom], start, end)
-    overlapped_hits_regions = get_el(hits_regions[chrom], start, end)
-    
-    return np.array([
-        len(overlapped_genes),  # gencode_genes
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["protein_coding"]),
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["pseudogene"]),
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["miRNA"]),
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["lncRNA"]),
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["rRNA"]),
-        np.sum(overlapped_genes[:, 3] == settings.gene_type_dict["snRNA"]),
-        np.sum(overlapped_genes[:, 4]),  # morbid genes
-        np.sum(overlapped_genes[:, 5]),  # disease associated genes
-        len(overlapped_hi_genes),
-        np.sum(overlapped_hits_regions[:, 3]),  # HI regions
-        np.sum(overlapped_hits_regions[:, 4]),  # TS regions
-        len(overlapped_regulatory),  # all overlapped regulatory elements
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["enhancer"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["open_chromatin_region"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["promoter"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["promoter_flanking_region"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["CTCF_binding_site"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["TF_binding_site"]),
-        np.sum(overlapped_regulatory[:, 3] == settings.regulatory_type_dict["curated"])
-    ], dtype=np.int32)
+    n_attributes = 0
+    for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+        n_attributes += index.start_cum.shape[1]
+
+    out = np.empty(n_attributes, dtype=np.int32)
+    annotate_cnv_into(out, chrom, start, end, gencode_genes, regulatory, hi_genes, hits_regions)
+    return out
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def annotate_cnvs(chroms, starts, ends, gencode_genes, regulatory, hi_genes, hits_regions):
+    """Annotate a batch of candidate CNVs in parallel
+
+    :param chroms: array of chromosome numbers (1-24)
+    :param starts: array of start positions on the GRCh38 assembly
+    :param ends: array of end positions on the GRCh38 assembly
+    :param gencode_genes: gencode genes IntervalIndex
+    :param regulatory: regulatory elements IntervalIndex
+    :param hi_genes: hi_genes IntervalIndex
+    :param hits_regions: hi_regions and ts regions IntervalIndex
+
+    :return: (n, len(settings.attributes)) int32 array of annotations
+    """
+    n_attributes = 0
+    for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+        n_attributes += index.start_cum.shape[1]
+
+    annotated = np.empty((chroms.shape[0], n_attributes), dtype=np.int32)
+    for i in nb.prange(chroms.shape[0]):
+        annotate_cnv_into(annotated[i], chroms[i], starts[i], ends[i],
+                          gencode_genes, regulatory, hi_genes, hits_regions)
+
+    return annotated
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def annotate_windows(chroms, first_starts, sizes, counts, step, gencode_genes, regulatory, hi_genes, hits_regions):
+    """Annotate blocks of windows of a tiling grid in parallel
+
+    Windows of a block have the same size and start at first_start + i * step on the same chromosome, so they are
+    annotated by sweeping over the sorted databases (see sweep_overlaps_into)
+
+    :param chroms: array of chromosome numbers (1-24) of blocks
+    :param first_starts: array of starts of the first windows of blocks
+    :param sizes: array of window sizes of blocks
+    :param counts: array of numbers of windows of blocks
+    :param step: distance between starts of consecutive windows
+    :param gencode_genes: gencode genes IntervalIndex
+    :param regulatory: regulatory elements IntervalIndex
+    :param hi_genes: hi_genes IntervalIndex
+    :param hits_regions: hi_regions and ts regions IntervalIndex
+
+    :return: (sum of counts, len(settings.attributes)) int32 array of annotations, blocks in the given order
+    """
+    n_attributes = 0
+    for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+        n_attributes += index.start_cum.shape[1]
+
+    offsets = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    annotated = np.empty((offsets[-1], n_attributes), dtype=np.int32)
+    for b in nb.prange(chroms.shape[0]):
+        rows = annotated[offsets[b]:offsets[b + 1]]
+        j = 0
+        for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+            k = index.start_cum.shape[1]
+            sweep_overlaps_into(rows[:, j:(j + k)], index, chroms[b], first_starts[b], step, sizes[b])
+            j += k
+
+    return annotated
 
 
 # %%
-def annotate(cnvs):
+def annotate(cnvs, n_threads: int = None):
     """
-    :param cnvs: a list, np.array or pandas dataframe with 4 columns representing chromosome (eg, chr3), \
-    cnv start (grch38), cnv end (grch38) and cnv_type (DUP or DEL)
+    :param cnvs: a list, np.array, pandas dataframe or arrow table with 4 columns representing chromosome \
+    (eg, chr3), cnv start (grch38), cnv end (grch38) and cnv_type (DUP or DEL)
+    :param n_threads: number of threads used for annotation. Defaults to settings.n_threads, or all available \
+    cores if not set
 
-    :return: pd DataFrame of annotated CNVs
+    :return: pd DataFrame of annotated CNVs. Chromosome and cnv type are categorical, counts are int32
     """
     if isinstance(cnvs, list) or isinstance(cnvs, np.ndarray):
         cnvs = pd.DataFrame(cnvs)
+    elif is_arrow(cnvs):
+        cnvs = from_arrow(cnvs)
     
     assert isinstance(cnvs, pd.core.frame.DataFrame),\
-        "Please supply a list, np.array or pandas dataframe with 4 columns\
+        "Please supply a list, np.array, pandas dataframe or arrow table with 4 columns\
             representing the chromosome id, start (grch38), end (grch38)\
                 and cnv_type (eiter DUP or DEL)"
     
@@ -110,26 +309,50 @@ def annotate(cnvs):
     # Just in case something is wrong with indexes
     cnvs.reset_index(inplace=True, drop=True)
 
-    # Make sure that chromosomes are in the right format
-    cnvs.chrom = [i if i.startswith("chr") else f"chr{i}" for i in cnvs.chrom]
+    # Make sure that chromosomes are in the right format. Only distinct chromosome names are translated
+    chrom = pd.Categorical(cnvs.chrom)
+    names = [str(i) if str(i).startswith("chr") else f"chr{i}" for i in chrom.categories]
+    # chromosome numbers (1-24), 0 for unknown chromosomes and missing values (code -1)
+    lookup = np.array([settings.chromosome_dict.get(i, 0) for i in names] + [0], dtype=np.int64)
+    chroms = lookup[chrom.codes]
+    if (chroms == 0).any():
+        code = chrom.codes[np.argmax(chroms == 0)]
+        raise KeyError(names[code] if code >= 0 else None)
 
-    # Load databases
-    print("Loading databases")
-    gencode_genes = open_data(os.path.join(settings.data_dir, "preprocessed", "gencode_genes.json.gz"))
-    regulatory = open_data(os.path.join(settings.data_dir, "preprocessed", "regulatory.json.gz"))
-    hi_genes = open_data(os.path.join(settings.data_dir, "preprocessed", "hi_genes.json.gz"))
-    hits_regions = open_data(os.path.join(settings.data_dir, "preprocessed", "hits_regions.json.gz"))
-    
-    # annotate cnvs
-    print("Annotating CNVs")
-    annotated = np.empty((cnvs.shape[0], len(settings.attributes)), dtype=np.int64)
-    start = time.time()
-    for i, cnv in cnvs.iterrows():
-        annotated[i] = annotate_cnv(settings.chromosome_dict[cnv.chrom],
-                                    cnv.start, cnv.end, gencode_genes,
-                                    regulatory, hi_genes, hits_regions)
-    
-    elapsed = round(time.time() - start, 9)
-    print(f"Annotated in {elapsed} seconds")
-    
-    return pd.concat([cnvs, pd.DataFrame(annotated, columns=settings.attributes)], axis=1)
+    # categories follow the order of settings.valid_chromosomes
+    cnvs.chrom = pd.Categorical.from_codes(chroms - 1, categories=settings.valid_chromosomes)
+    cnvs.cnv_type = pd.Categorical(cnvs.cnv_type, categories=["DEL", "DUP"])
+
+    gencode_genes, regulatory, hi_genes, hits_regions = load_databases()
+
+    if n_threads is None:
+        n_threads = settings.n_threads
+
+    def compute(df):
+        default_threads = nb.get_num_threads()
+        if n_threads is not None:
+            nb.set_num_threads(min(n_threads, nb.config.NUMBA_NUM_THREADS))
+        try:
+            with profiling.stage("annotate"):
+                annotated = annotate_cnvs(chroms[df.index.values],
+                                          df.start.values.astype(np.int64, copy=False),
+                                          df.end.values.astype(np.int64, copy=False),
+                                          gencode_genes, regulatory, hi_genes, hits_regions)
+        finally:
+            nb.set_num_threads(default_threads)
+
+        if profiling.enabled():
+            profiling.count("cnvs_annotated", len(df))
+            # genes, regulatory elements and haploinsufficient genes
+            totals = [settings.attributes.index(i) for i in ["gencode_genes", "regulatory", "hi_genes"]]
+            profiling.count("elements_overlapped", int(annotated[:, totals].sum()))
+        return annotated
+
+    annotated = cached_rows("annotation", cnvs, compute)
+
+    # wrap the annotation matrix without copying it, and add coordinates in front
+    res = pd.DataFrame(annotated, columns=settings.attributes, copy=False)
+    for i, column in enumerate(["chrom", "start", "end", "cnv_type"]):
+        res.insert(i, column, cnvs[column].values)
+
+    return res
@@ -7,6 +7,15 @@ class Settings:
         root_dir = str(pathlib.Path(__file__).parent.absolute())
         self.model_dir = os.path.join(root_dir, 'models')
         self.data_dir = os.path.join(root_dir, 'data')
+        # number of threads used by the annotation kernel, None for all available cores
+        self.n_threads = None
+        # background dataset of SHAP explainers, either 'full' (training set) or 'sample' (stratified sample)
+        self.shap_background = 'full'
+        # SHAP method, either 'exact' (interventional TreeExplainer), 'xgboost' (native path dependent tree SHAP)
+        # or 'approximate' (Saabas path attribution)
+        self.shap_method = 'exact'
+        # prediction backend, either 'xgboost' or 'numba' (compiled evaluator of the xgboost JSON models)
+        self.predict_backend = 'xgboost'
         self.valid_chromosomes = [f'chr{i}' for i in range(1, 23)] + ['chrX', 'chrY']
         self.chromosome_dict = dict(zip(self.valid_chromosomes, range(1, 25)))
 
@@ -1,13 +1,14 @@
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-from plotly.offline import plot
 
 from isv.annotate import annotate
 from isv.predict import predict as predict_cnvs
-from isv.scripts.constants import LOSS_ATTRIBUTES, GAIN_ATTRIBUTES, HUMAN_READABLE, DESCRIPTIONS
 from isv.scripts.helpers import check_cnvs_obj
-from isv.shap_vals import shap_values, shap_values_with_same_cnv_type
+from isv.scripts.parallel import n_processes
+from isv.scripts import profiling
+from isv.shap_vals import shap_values
+from isv.report import waterfall_data, waterfall_figure, waterfall_report
+from isv.sensitivity import breakpoint_sensitivity
 
 
 class ISV:
@@ -15,43 +16,59 @@ class ISV:
 
     :param cnvs: a list, np.array or pandas dataframe with 4 columns representing chromosome (eg, chr3), \
     cnv start (grch38), cnv end (grch38) and cnv_type (DUP or DEL)
+    :param n_jobs: number of cores used for annotation, and number of processes used for predictions and \
+    SHAP values (-1 for all cores). Where worker processes can be forked, they share loaded databases, models \
+    and explainers. Otherwise they are spawned, and scripts have to guard their entry point with \
+    ``if __name__ == "__main__":``
 
     :return: ISV output as a pandas dataframe
     """
 
-    def __init__(self, cnvs):
+    def __init__(self, cnvs, n_jobs: int = 1):
 
         cnvs = check_cnvs_obj(cnvs)
 
         cnvs.columns = ["chromosome", "start", "end", "cnv_type"]
 
-        self.annotated = annotate(cnvs)
+        self.n_jobs = n_jobs
+        self.annotated = annotate(cnvs, n_threads=None if n_jobs == 1 else n_processes(n_jobs))
         self.cnvs = cnvs
 
-    def predict(self, proba: bool = True, threshold: float = 0.95):
+    def predict(self, proba: bool = True, threshold: float = 0.95, backend: str = None):
         """Generate ISV predictions
 
         :param proba: whether probabilities should be calculated
         :param threshold: probability threshold for classifying CNVs into three classes: Pathogenic (>= threshold), \
         Uncertain significance ((1-threshold, threshold)) or Benign (<= 1 - threshold)
+        :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
 
-        :return: dataframe with last column representing the ISV predictions
+        :return: dataframe with last column representing the ISV predictions. Columns of the CNVs are shared with \
+        self.cnvs, not copied
         """
-        res = self.cnvs.copy()
-        res["ISV"] = predict_cnvs(self.annotated, proba=proba, threshold=threshold)
-        return res
+        yh = predict_cnvs(self.annotated, proba=proba, threshold=threshold, n_jobs=self.n_jobs, backend=backend)
+        return pd.concat([self.cnvs, pd.Series(yh, index=self.cnvs.index, name="ISV")], axis=1, copy=False)
 
-    def shap(self, df: pd.core.frame.DataFrame = None):
+    def shap(self, df: pd.core.frame.DataFrame = None, background: str = None, cnv_indexes=None,
+             proba_range=None, method: str = None, output: str = "probability"):
         """Calculate SHAP values
 
+        :param background: background dataset, either "full" or "sample". See isv.shap_values
+        :param cnv_indexes: positions of CNVs which should be explained. Defaults to all CNVs
+        :param proba_range: tuple (low, high), only CNVs with low < predicted probability < high are explained
+        :param method: either "exact", "xgboost" or "approximate". See isv.shap_values
+        :param output: either "probability" or "log_odds". See isv.shap_values
+
         :return: dataframe of shap values
         """
+        kwargs = dict(background=background, n_jobs=self.n_jobs, cnv_indexes=cnv_indexes, proba_range=proba_range,
+                      method=method, output=output)
         if df is not None:
-            return shap_values(df)
+            return shap_values(df, **kwargs)
 
-        sv = shap_values(self.annotated)
+        sv = shap_values(self.annotated, **kwargs)
         return pd.concat([self.cnvs, sv], axis=1)
 
+    @profiling.stage("waterfall")
     def waterfall(self,
                   cnv_index: int,
                   filepath: str = "temp-plot.html",
@@ -61,6 +78,8 @@ class ISV:
                   text_position: str = 'outside',  # 'none' for no text
                   width: int = 800,
                   height: int = 800,
+                  background: str = None,
+                  method: str = None,
                   ):
         """Waterfall plot for CNV at specified index
 
@@ -72,153 +91,55 @@ class ISV:
         :param text_position: text position
         :param width: figure width
         :param height: figure height
+        :param background: background dataset of SHAP values, either "full" or "sample"
+        :param method: SHAP method, either "exact", "xgboost" or "approximate". Defaults to settings.shap_method
 
         :return: html plot
         """
-        cnv_type = ["loss", "gain"][(self.cnvs.iloc[cnv_index:(cnv_index + 1)].cnv_type.item() == "gain") * 1]
-
-        sv = shap_values_with_same_cnv_type(self.annotated.iloc[cnv_index:(cnv_index + 1)],
-                                            cnv_type,
-                                            raw=True)
-
-        visibility_dict = {
-            'default': [True, False, False],
-            'sorted': [False, True, False],
-            'abs_sorted': [False, False, True]
-        }
-
-        attributes = [LOSS_ATTRIBUTES, GAIN_ATTRIBUTES][(cnv_type == 'gain') * 1]
-        feature_names = [HUMAN_READABLE[i] for i in attributes]
-        descriptions = [DESCRIPTIONS[i] for i in attributes]
-
-        # DataFrame for Bar Charts
-        data = pd.DataFrame({'Feature': feature_names,  # Nice Feature without SHAP prefix
-                             'Descriptions': descriptions,
-                             'Value': sv.data[0],
-                             'SHAP': sv.values[0],
-                             'raw': self.annotated.loc[:, attributes].iloc[cnv_index].values,
-                             'colors': [pathogenic_color if i > 0 else benign_color for i in sv.values[0]]})
-
-        data = data.iloc[::-1]
-
-        # sort data by SHAP value
-        sorted_data = data.iloc[np.argsort(data.SHAP)]
-
-        # sort data by absoulte SHAP value
-        abs_sorted_data = data.iloc[np.argsort(np.abs(data.SHAP))]
-
-        # hover text formating
-        hover_text = '{}<br>Value: {:2.3f}'
-
-        v = visibility_dict['sorted']  # default visibility
-
-        fig = go.Figure()
-
-        for i, temp in enumerate([data, sorted_data, abs_sorted_data]):
-            # add value to the left of the name of the feature
-            temp["alt_Feature"] = [
-                f'<span style="font-size: 10px; color: gray">({temp.raw.iloc[i]})</span> = <span style="font-size: ' \
-                f'14px;">{temp.Feature.iloc[i]}</span> '
-                for i in range(len(temp))]
-
-            # Main Bar Plot
-            fig.add_trace(
-                go.Waterfall(
-                    x=temp.SHAP,
-                    y=temp.alt_Feature,
-                    base=sv.base_values[0],
-                    orientation='h',
-                    hovertext=[hover_text.format(temp.Descriptions.iloc[i], temp.raw.iloc[i]) for i in
-                               range(len(temp))],
-                    hoverinfo="text + delta + initial",
-                    connector={"mode": "between", "line": {"width": 0.2, "color": "gray", "dash": "solid"}},
-                    decreasing={
-                        "marker": {"color": benign_color, "line": {'width': 0.1}}},
-                    increasing={"marker": {"color": pathogenic_color, "line": {'width': 0}}},
-                    name='Pathogenic/Benign',
-                    visible=v[i],
-                    text=[np.round(i, 2) if i <= 0 else f'+{np.round(i, 2)}' for i in temp.SHAP],
-                    textposition=text_position,
-                    textfont={'color': 'gray'}
-                )
-            )
-
-        # Buttons
-        fig.update_layout(
-            updatemenus=[
-                dict(
-                    type="buttons",
-                    direction="left",
-                    active=1,
-                    buttons=list([
-                        dict(
-                            label="Default",
-                            args=[
-                                {"visible": visibility_dict['default']}
-                            ]
-                        ),
-                        dict(
-                            label="Sorted",
-                            args=[
-                                {"visible": visibility_dict['sorted']}
-                            ],
-                        ),
-                        dict(
-                            label="Abs Sorted",
-                            args=[
-                                {"visible": visibility_dict['abs_sorted']}
-                            ]
-                        )
-                    ]),
-                    pad={"r": 10, "t": 10},
-                    showactive=True,
-                    x=0.11,
-                    xanchor="left",
-                    y=1.1,
-                    yanchor="top"
-                ),
-            ]
-        )
-
-        fig.add_shape(type='line',
-                      x0=sv.base_values[0],
-                      y0=0,
-                      x1=sv.base_values[0],
-                      y1=len(data),
-                      line=dict(color='grey', width=0.3, dash='dash'),
-                      )
-
-        # General Layout
-        chrom, start, end, cnv_type = self.cnvs.iloc[cnv_index].values
-        fig.update_layout(
-            template='plotly_white',
-            # showlegend=True,
-            xaxis_title=None,
-            yaxis_title=None,
-            title=dict(text=f"{['Deletion', 'Duplication'][cnv_type == 'DUP']} of {chrom}:{start}-{end}"),
-            legend=dict(
-                itemclick=False,
-                itemdoubleclick=False,
-                orientation="h",
-                yanchor="bottom",
-                y=1,
-                xanchor="right",
-                x=0.5
-            ),
-            width=width,
-            height=height,
-            xaxis={"showgrid": True,
-                   "nticks": 5,
-                   "range": [sv.base_values[0] + np.min(np.cumsum(sv.values[0])) - 0.25, \
-                             sv.base_values[0] + np.max(np.cumsum(sv.values[0])) + 0.1]},
-            hoverlabel=dict(
-                font_size=16,
-                font_family="Rockwell",
-                font=dict(color='white')
-            ),
-            margin=dict(t=20, b=20, l=180, r=0),
-        )
+        from plotly.offline import plot
+
+        data = waterfall_data(self, [cnv_index], background, method)
+        cnv = data.iloc[0]
+        fig = waterfall_figure(cnv.chrom, cnv.start, cnv.end, cnv.cnv_type, cnv.shap_values, cnv.raw, cnv.base_value,
+                               pathogenic_color=pathogenic_color,
+                               benign_color=benign_color,
+                               text_position=text_position,
+                               width=width,
+                               height=height)
 
         if return_fig:
             return fig
-        plot(fig, filename=filepath)
+        with profiling.stage("plot"):
+            plot(fig, filename=filepath)
+
+    def waterfall_report(self, filepath: str, cnv_indexes=None, background: str = None, fmt: str = "html",
+                         include_plotlyjs=True, method: str = None, shap_values=None, **style):
+        """Waterfall plots of many CNVs, with SHAP values computed at once and plots rendered in n_jobs processes
+
+        :param filepath: path to a combined html file (ending with '.html'), or to a directory for per CNV files
+        :param cnv_indexes: positions of CNVs. Defaults to all CNVs
+        :param background: background dataset of SHAP values, either "full" or "sample"
+        :param fmt: "html" or "png" (per CNV files only, requires kaleido)
+        :param include_plotlyjs: how the combined html file includes plotly.js: True (inlined once) or "cdn"
+        :param method: SHAP method, either "exact", "xgboost" or "approximate". Defaults to settings.shap_method
+        :param shap_values: SHAP values of all CNVs, as returned by shap(self.annotated). Computed if not given
+        :param style: pathogenic_color, benign_color, text_position, width and height. See waterfall
+
+        :return: list of written files
+        """
+        return waterfall_report(self, filepath, cnv_indexes, background, fmt, include_plotlyjs, method=method,
+                                shap_values=shap_values, **style)
+
+    def sensitivity(self, start_uncertainty, end_uncertainty, threshold: float = 0.95, backend: str = None):
+        """Range of ISV predictions within uncertainty ranges of breakpoints
+
+        :param start_uncertainty: int (start +- uncertainty), tuple of offsets (lower, upper), or array of shape \
+        (n, 2) of per CNV offsets
+        :param end_uncertainty: same for the end
+        :param threshold: probability threshold for classifying CNVs into three classes. See predict
+        :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
+
+        :return: dataframe with the CNVs and the columns of isv.sensitivity.breakpoint_sensitivity
+        """
+        res = breakpoint_sensitivity(self.annotated, start_uncertainty, end_uncertainty, threshold, backend)
+        return pd.concat([self.cnvs.reset_index(drop=True), res], axis=1)
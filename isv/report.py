@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Waterfall plots of SHAP values
+
+Batch reports compute SHAP values of all requested CNVs at once, render plots in worker processes and share a single
+plotly.js include, either inlined once in a combined html file or written once next to per CNV files.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from isv.scripts.constants import LOSS_ATTRIBUTES, GAIN_ATTRIBUTES, HUMAN_READABLE, DESCRIPTIONS
+from isv.scripts.parallel import map_chunks
+from isv.scripts import profiling
+from isv.shap_vals import shap_values as compute_shap_values, expected_value
+
+
+def waterfall_figure(chrom, start, end, cnv_type, shap_values, raw, base_value,
+                     pathogenic_color: str = "rgb(255, 0, 50)",
+                     benign_color: str = "rgb(58, 130, 255)",
+                     text_position: str = 'outside',  # 'none' for no text
+                     width: int = 800,
+                     height: int = 800,
+                     ):
+    """Waterfall plot of SHAP values of a single CNV
+
+    :param chrom: chromosome
+    :param start: start position on the GRCh38 assembly
+    :param end: end position on the GRCh38 assembly
+    :param cnv_type: cnv type (DEL or DUP)
+    :param shap_values: SHAP values of attributes of the cnv type
+    :param raw: raw counts of attributes of the cnv type
+    :param base_value: expected model output of the SHAP explainer
+    :param pathogenic_color: color of bars pushing predictions to pathogenic values
+    :param benign_color: color of bars pushing predictions to benign values
+    :param text_position: text position
+    :param width: figure width
+    :param height: figure height
+
+    :return: plotly figure
+    """
+    import plotly.graph_objects as go
+
+    visibility_dict = {
+        'default': [True, False, False],
+        'sorted': [False, True, False],
+        'abs_sorted': [False, False, True]
+    }
+
+    attributes = [LOSS_ATTRIBUTES, GAIN_ATTRIBUTES][(cnv_type == 'DUP') * 1]
+    feature_names = [HUMAN_READABLE[i] for i in attributes]
+    descriptions = [DESCRIPTIONS[i] for i in attributes]
+
+    # DataFrame for Bar Charts
+    data = pd.DataFrame({'Feature': feature_names,  # Nice Feature without SHAP prefix
+                         'Descriptions': descriptions,
+                         'SHAP': shap_values,
+                         'raw': raw,
+                         'colors': [pathogenic_color if i > 0 else benign_color for i in shap_values]})
+
+    data = data.iloc[::-1]
+
+    # sort data by SHAP value
+    sorted_data = data.iloc[np.argsort(data.SHAP)]
+
+    # sort data by absoulte SHAP value
+    abs_sorted_data = data.iloc[np.argsort(np.abs(data.SHAP))]
+
+    # hover text formating
+    hover_text = '{}<br>Value: {:2.3f}'
+
+    v = visibility_dict['sorted']  # default visibility
+
+    fig = go.Figure()
+
+    for i, temp in enumerate([data, sorted_data, abs_sorted_data]):
+        # add value to the left of the name of the feature
+        temp["alt_Feature"] = [
+            f'<span style="font-size: 10px; color: gray">({temp.raw.iloc[i]})</span> = <span style="font-size: ' \
+            f'14px;">{temp.Feature.iloc[i]}</span> '
+            for i in range(len(temp))]
+
+        # Main Bar Plot
+        fig.add_trace(
+            go.Waterfall(
+                x=temp.SHAP,
+                y=temp.alt_Feature,
+                base=base_value,
+                orientation='h',
+                hovertext=[hover_text.format(temp.Descriptions.iloc[i], temp.raw.iloc[i]) for i in
+                           range(len(temp))],
+                hoverinfo="text + delta + initial",
+                connector={"mode": "between", "line": {"width": 0.2, "color": "gray", "dash": "solid"}},
+                decreasing={
+                    "marker": {"color": benign_color, "line": {'width': 0.1}}},
+                increasing={"marker": {"color": pathogenic_color, "line": {'width': 0}}},
+                name='Pathogenic/Benign',
+                visible=v[i],
+                text=[np.round(i, 2) if i <= 0 else f'+{np.round(i, 2)}' for i in temp.SHAP],
+                textposition=text_position,
+                textfont={'color': 'gray'}
+            )
+        )
+
+    # Buttons
+    fig.update_layout(
+        updatemenus=[
+            dict(
+                type="buttons",
+                direction="left",
+                active=1,
+                buttons=list([
+                    dict(
+                        label="Default",
+                        args=[
+                            {"visible": visibility_dict['default']}
+                        ]
+                    ),
+                    dict(
+                        label="Sorted",
+                        args=[
+                            {"visible": visibility_dict['sorted']}
+                        ],
+                    ),
+                    dict(
+                        label="Abs Sorted",
+                        args=[
+                            {"visible": visibility_dict['abs_sorted']}
+                        ]
+                    )
+                ]),
+                pad={"r": 10, "t": 10},
+                showactive=True,
+                x=0.11,
+                xanchor="left",
+                y=1.1,
+                yanchor="top"
+            ),
+        ]
+    )
+
+    fig.add_shape(type='line',
+                  x0=base_value,
+                  y0=0,
+                  x1=base_value,
+                  y1=len(data),
+                  line=dict(color='grey', width=0.3, dash='dash'),
+                  )
+
+    # General Layout
+    fig.update_layout(
+        template='plotly_white',
+        # showlegend=True,
+        xaxis_title=None,
+        yaxis_title=None,
+        title=dict(text=f"{['Deletion', 'Duplication'][cnv_type == 'DUP']} of {chrom}:{start}-{end}"),
+        legend=dict(
+            itemclick=False,
+            itemdoubleclick=False,
+            orientation="h",
+            yanchor="bottom",
+            y=1,
+            xanchor="right",
+            x=0.5
+        ),
+        width=width,
+        height=height,
+        xaxis={"showgrid": True,
+               "nticks": 5,
+               "range": [base_value + np.min(np.cumsum(shap_values)) - 0.25, \
+                         base_value + np.max(np.cumsum(shap_values)) + 0.1]},
+        hoverlabel=dict(
+            font_size=16,
+            font_family="Rockwell",
+            font=dict(color='white')
+        ),
+        margin=dict(t=20, b=20, l=180, r=0),
+    )
+
+    return fig
+
+
+def waterfall_data(cnv_isv, cnv_indexes=None, background: str = None, method: str = None, shap_values=None):
+    """Inputs of waterfall plots of selected CNVs. SHAP values of all of them are computed at once
+
+    :param cnv_isv: ISV object
+    :param cnv_indexes: positions of CNVs. Defaults to all CNVs
+    :param background: background dataset of SHAP values, either "full" or "sample". See isv.shap_values
+    :param method: SHAP method, either "exact", "xgboost" or "approximate". Defaults to settings.shap_method
+    :param shap_values: SHAP values (probabilities) of all CNVs of cnv_isv computed with the same background and \
+    method, as returned by cnv_isv.shap(cnv_isv.annotated). Computed if not given
+
+    :return: dataframe with one row per CNV, with cnv_index, chrom, start, end, cnv_type, base_value, \
+    shap_values and raw columns
+    """
+    if cnv_indexes is None:
+        cnv_indexes = np.arange(len(cnv_isv.annotated))
+    cnv_indexes = np.asarray(cnv_indexes).reshape(-1)
+
+    annotated = cnv_isv.annotated.iloc[cnv_indexes].reset_index(drop=True)
+    if shap_values is None:
+        sv = compute_shap_values(annotated, background=background, n_jobs=cnv_isv.n_jobs, method=method)
+    else:
+        sv = shap_values.iloc[cnv_indexes].reset_index(drop=True)
+
+    data = pd.DataFrame({"cnv_index": cnv_indexes,
+                         "chrom": annotated.chrom.astype(str).values,
+                         "start": annotated.start.values,
+                         "end": annotated.end.values,
+                         "cnv_type": annotated.cnv_type.astype(str).values,
+                         "base_value": np.nan,
+                         "shap_values": None,
+                         "raw": None})
+
+    for cnv_type, model_type, attributes in [("DEL", "loss", LOSS_ATTRIBUTES), ("DUP", "gain", GAIN_ATTRIBUTES)]:
+        ind = np.where(data.cnv_type == cnv_type)[0]
+        if len(ind) == 0:
+            continue
+        shap_columns = ['SHAP_' + HUMAN_READABLE[i].replace(' ', '_') for i in attributes]
+        data.loc[ind, "base_value"] = expected_value(model_type, background, method)
+        data.loc[ind, "shap_values"] = pd.Series(list(sv.loc[ind, shap_columns].values), index=ind)
+        data.loc[ind, "raw"] = pd.Series(list(annotated.loc[ind, attributes].values), index=ind)
+
+    return data
+
+
+def render(data, fmt: str = "div", **style):
+    """Render waterfall plots
+
+    :param data: dataframe of plot inputs, as returned by waterfall_data
+    :param fmt: "div" (html fragment without plotly.js), "html" (html page referencing plotly.min.js in the same \
+    directory) or "png" (requires kaleido)
+    :param style: keyword arguments of waterfall_figure
+
+    :return: list of html strings or png bytes
+    """
+    import plotly.io as pio
+
+    res = []
+    for row in data.itertuples(index=False):
+        fig = waterfall_figure(row.chrom, row.start, row.end, row.cnv_type, row.shap_values, row.raw, row.base_value,
+                               **style)
+        if fmt == "png":
+            res.append(fig.to_image(format="png"))
+        else:
+            res.append(pio.to_html(fig, full_html=(fmt == "html"),
+                                   include_plotlyjs=False if fmt == "div" else "directory"))
+    return res
+
+
+def waterfall_report(cnv_isv, filepath: str, cnv_indexes=None, background: str = None, fmt: str = "html",
+                     include_plotlyjs=True, n_jobs: int = None, method: str = None, shap_values=None, **style):
+    """Waterfall plots of many CNVs
+
+    With a filepath ending with '.html', a single html file with all plots is written, sharing one plotly.js \
+    include. Otherwise filepath is a directory, and a file is written for each CNV. Html files reference a \
+    plotly.min.js written once to the same directory
+
+    :param cnv_isv: ISV object
+    :param filepath: path to the combined html file, or to the output directory
+    :param cnv_indexes: positions of CNVs. Defaults to all CNVs
+    :param background: background dataset of SHAP values, either "full" or "sample". See isv.shap_values
+    :param fmt: "html" or "png" (per CNV files only, requires kaleido)
+    :param include_plotlyjs: how the combined html file includes plotly.js: True (inlined once) or "cdn"
+    :param n_jobs: number of processes rendering plots. Defaults to the n_jobs of cnv_isv
+    :param method: SHAP method, either "exact", "xgboost" or "approximate". Defaults to settings.shap_method
+    :param shap_values: precomputed SHAP values of all CNVs. See waterfall_data
+    :param style: keyword arguments of waterfall_figure (colors, text_position, width and height)
+
+    :return: list of written files
+    """
+    from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+    assert fmt in ["html", "png"], "fmt has to be either 'html' or 'png'"
+    combined = filepath.endswith(".html")
+    assert not (combined and fmt == "png"), "png plots are written to a directory"
+
+    data = waterfall_data(cnv_isv, cnv_indexes, background, method, shap_values)
+    if n_jobs is None:
+        n_jobs = cnv_isv.n_jobs
+
+    with profiling.stage("plot"):
+        rendered = [r for chunk in map_chunks(render, data, n_jobs, fmt="div" if combined else fmt, **style)
+                    for r in chunk]
+
+    if combined:
+        if include_plotlyjs == "cdn":
+            script = f'<script src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js"></script>'
+        else:
+            script = f'<script type="text/javascript">{get_plotlyjs()}</script>'
+
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write(f'<html>\n<head><meta charset="utf-8" />{script}</head>\n<body>\n')
+            for div in rendered:
+                f.write(div + "\n")
+            f.write("</body>\n</html>\n")
+        return [filepath]
+
+    os.makedirs(filepath, exist_ok=True)
+    if fmt == "html":
+        with open(os.path.join(filepath, "plotly.min.js"), "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+
+    paths = []
+    for row, content in zip(data.itertuples(index=False), rendered):
+        path = os.path.join(filepath, f"{row.cnv_index}_{row.chrom}_{row.start}_{row.end}_{row.cnv_type}.{fmt}")
+        with open(path, "wb" if fmt == "png" else "w", encoding=None if fmt == "png" else "utf-8") as f:
+            f.write(content)
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Genome wide scan of ISV predictions on a tiling grid of windows
+
+Windows of each size start at 1, 1 + step, 1 + 2 * step, ... and end at start + size - 1 within the chromosome.
+Windows are annotated chromosome by chromosome by sweeping over the sorted databases, and scored in batches as
+deletions and/or duplications. The result is a compact track with one row per window.
+
+Run with ``python -m isv.scan -s 100000 1000000 5000000 --step 50000 -o track.parquet``
+"""
+from argparse import ArgumentParser
+
+import numba as nb
+import numpy as np
+import pandas as pd
+
+from isv.annotate import load_databases, annotate_windows
+from isv.config import settings
+from isv.predict import predict_with_same_cnv_type
+from isv.scripts import profiling
+from isv.scripts.constants import CHROMOSOME_LENGTHS
+
+# number of windows annotated by a single sweep, blocks are annotated in parallel
+BLOCK_SIZE = 4096
+
+
+def window_blocks(chrom: str, sizes, step: int):
+    """Blocks of windows of a chromosome
+
+    :param chrom: chromosome name (eg. chr3)
+    :param sizes: window sizes
+    :param step: distance between starts of consecutive windows
+
+    :return: tuple of int64 arrays (first starts, sizes, counts) of blocks
+    """
+    first_starts, block_sizes, counts = [], [], []
+    for size in sizes:
+        n = max((CHROMOSOME_LENGTHS[chrom] - size) // step + 1, 0)
+        for first in range(0, n, BLOCK_SIZE):
+            first_starts.append(1 + first * step)
+            block_sizes.append(size)
+            counts.append(min(BLOCK_SIZE, n - first))
+    return tuple(np.array(i, dtype=np.int64) for i in [first_starts, block_sizes, counts])
+
+
+def scan_chromosome(chrom: str, sizes, step: int, cnv_types=("DEL", "DUP"), backend: str = None):
+    """Scan windows of a single chromosome
+
+    :param chrom: chromosome name (eg. chr3)
+    :param sizes: window sizes
+    :param step: distance between starts of consecutive windows
+    :param cnv_types: cnv types which windows are scored as
+    :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
+
+    :return: pandas dataframe with chrom, start, end, and ISV_loss and/or ISV_gain (float32) columns
+    """
+    first_starts, block_sizes, counts = window_blocks(chrom, sizes, step)
+    chroms = np.full(len(counts), settings.chromosome_dict[chrom], dtype=np.int64)
+
+    with profiling.stage("annotate"):
+        annotated = annotate_windows(chroms, first_starts, block_sizes, counts, step, *load_databases())
+    profiling.count("windows_annotated", len(annotated))
+
+    starts = np.concatenate([first + step * np.arange(n) for first, n in zip(first_starts, counts)] +
+                            [np.zeros(0, dtype=np.int64)])
+    res = pd.DataFrame({
+        "chrom": pd.Categorical.from_codes(np.full(len(starts), settings.chromosome_dict[chrom] - 1),
+                                           categories=settings.valid_chromosomes),
+        "start": starts.astype(np.int32),
+        "end": (starts + np.repeat(block_sizes, counts) - 1).astype(np.int32),
+    })
+
+    annotated = pd.DataFrame(annotated, columns=settings.attributes, copy=False)
+    for cnv_type in cnv_types:
+        name = {"DEL": "loss", "DUP": "gain"}[cnv_type]
+        res[f"ISV_{name}"] = predict_with_same_cnv_type(annotated, name, backend).astype(np.float32)
+
+    return res
+
+
+def scan(sizes, step: int, chromosomes=None, cnv_types=("DEL", "DUP"), backend: str = None,
+         n_threads: int = None):
+    """Predict pathogenicity of all windows of a tiling grid
+
+    Windows of a chromosome are annotated by sweeping over its elements, with each element added and removed \
+    once per block of BLOCK_SIZE windows of the same size, instead of two binary searches per window
+
+    :param sizes: window sizes, e.g. [100000, 1000000, 5000000]
+    :param step: distance between starts of consecutive windows
+    :param chromosomes: chromosome names. Defaults to all chromosomes
+    :param cnv_types: cnv types which windows are scored as, "DEL" (ISV_loss column) and/or "DUP" (ISV_gain)
+    :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
+    :param n_threads: number of threads used for annotation. Defaults to settings.n_threads, or all available \
+    cores if not set
+
+    :return: pandas dataframe with one row per window, ordered by chromosome, size and start
+    """
+    assert step > 0 and all(size > 0 for size in sizes), "window sizes and step have to be positive"
+    assert all(t in ["DEL", "DUP"] for t in cnv_types), "only 'DEL' and 'DUP' cnv types are allowed"
+    if chromosomes is None:
+        chromosomes = settings.valid_chromosomes
+    if n_threads is None:
+        n_threads = settings.n_threads
+
+    default_threads = nb.get_num_threads()
+    if n_threads is not None:
+        nb.set_num_threads(min(n_threads, nb.config.NUMBA_NUM_THREADS))
+    try:
+        res = [scan_chromosome(chrom, sizes, step, cnv_types, backend) for chrom in chromosomes]
+    finally:
+        nb.set_num_threads(default_threads)
+
+    return pd.concat(res, ignore_index=True)
+
+
+def write_track(track: pd.DataFrame, filepath: str):
+    """Write a scan result. Parquet (.parquet) and Arrow IPC (.feather, .arrow) keep compact dtypes and require
+    pyarrow, other files are tab separated
+
+    :param track: result of scan
+    :param filepath: output path
+    """
+    if filepath.endswith(".parquet"):
+        track.to_parquet(filepath, index=False)
+    elif filepath.endswith((".feather", ".arrow")):
+        track.to_feather(filepath)
+    else:
+        track.to_csv(filepath, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Genome wide scan of ISV predictions on a tiling grid of windows")
+
+    parser.add_argument("-s", "--sizes", required=True, type=int, nargs="+", help="window sizes")
+    parser.add_argument("--step", required=True, type=int, help="distance between starts of consecutive windows")
+    parser.add_argument("-c", "--chromosomes", required=False, nargs="+", choices=settings.valid_chromosomes,
+                        default=None, help="chromosomes. Defaults to all chromosomes")
+    parser.add_argument("-t", "--cnv-types", required=False, nargs="+", choices=["DEL", "DUP"],
+                        default=["DEL", "DUP"], help="cnv types which windows are scored as")
+    parser.add_argument("-b", "--backend", required=False, choices=["xgboost", "numba"], default=None,
+                        help="prediction backend")
+    parser.add_argument("-o", "--output", required=True, type=str,
+                        help="output file (.parquet, .feather or .arrow for compact binary tracks, tab separated "
+                             "otherwise)")
+
+    args = parser.parse_args()
+
+    track = scan(args.sizes, args.step, args.chromosomes, args.cnv_types, args.backend)
+    write_track(track, args.output)
+    print(f"{len(track)} windows saved to {args.output}")
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build preprocessed annotation databases from raw tables
+
+Raw tables (settings.data_dir/raw) are read in chunks, filtered to valid chromosomes and recoded to integers with
+vectorized operations, grouped by chromosome with a single stable sort and saved in the memory mappable binary
+format (and optionally as gzipped json), together with their interval indexes, which isv.annotate memory maps
+instead of building them in every process. The four databases are built in parallel processes.
+
+Digests of raw tables are recorded in a manifest next to the databases, so that an incremental build only rebuilds
+databases whose raw tables changed.
+
+Raw tables are not shipped with the package. The shipped gzipped json databases are converted to the binary format
+and indexed with from_json=True (python -m isv.scripts.build_databases --from-json), incrementally by their digests.
+"""
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from isv.config import settings
+from isv.scripts import profiling
+from isv.scripts.interval_index import PLACEHOLDER, build_index, save_index
+from isv.scripts.result_cache import file_digest
+
+# bump when the preprocessing changes, so that incremental builds rebuild all databases
+BUILD_VERSION = 1
+
+MANIFEST = "manifest.json"
+
+
+def recode_chromosomes(chromosomes):
+    """Translate chromosome names to ids
+
+    :param chromosomes: pandas series of chromosome names (eg. chr3)
+
+    :return: int64 array of ids, 0 for invalid chromosomes
+    """
+    return pd.Categorical(chromosomes, categories=settings.valid_chromosomes).codes.astype(np.int64) + 1
+
+
+def recode_types(types, type_dict, default=None):
+    """Translate element types to ids
+
+    :param types: pandas series of types
+    :param type_dict: dictionary of type ids
+    :param default: type of unknown types. If None, unknown types raise a ValueError
+
+    :return: int64 array of ids
+    """
+    codes = types.map(type_dict)
+    unknown = codes.isna()
+    if unknown.any():
+        if default is None:
+            raise ValueError(f"Unknown types: {sorted(types[unknown].astype(str).unique())}")
+        codes[unknown] = type_dict[default]
+    return codes.values.astype(np.int64)
+
+
+def gencode_chunk(chunk):
+    """Recode a chunk of gencode genes. Types containing "pseudogene" become pseudogene, types other than \
+    protein_coding, pseudogene, lncRNA, miRNA, rRNA and snRNA become unevaluated"""
+    types = chunk.type.mask(chunk.type.str.contains("pseudogene", regex=False, na=False), "pseudogene")
+    chunk = chunk.fillna(0)
+    chunk["type"] = recode_types(types, settings.gene_type_dict, default="unevaluated")
+    return chunk
+
+
+def regulatory_chunk(chunk):
+    """Recode a chunk of regulatory elements. Elements without a type are curated"""
+    chunk = chunk.fillna("curated")
+    chunk["type"] = recode_types(chunk.type, settings.regulatory_type_dict)
+    return chunk
+
+
+# raw table, dropped columns, recoding of a chunk and number of columns of json placeholders of each database
+SOURCES = {
+    "gencode_genes": ("gencode_annotsv.tsv.gz", ["gene_name"], gencode_chunk, 3),
+    "hi_genes": ("hi_genes.tsv.gz", [], None, 3),
+    "hits_regions": ("hits_regions.tsv.gz", [], None, 5),
+    "regulatory": ("regulatory.tsv.gz", ["id"], regulatory_chunk, 3),
+}
+
+
+def read_raw(path, drop=(), recode=None, chunksize: int = 1000000):
+    """Read a raw table in chunks and recode it to integers
+
+    :param path: path to a tab separated table with a chromosome column
+    :param drop: columns which are not read
+    :param recode: function recoding non chromosome columns of a chunk
+    :param chunksize: number of rows read at once
+
+    :return: int64 array of elements of valid chromosomes, in the order of the table
+    """
+    res = []
+    for chunk in pd.read_csv(path, sep='\t', usecols=lambda c: c not in drop, chunksize=chunksize):
+        chromosomes = recode_chromosomes(chunk.chromosome)
+        chunk = chunk.loc[chromosomes > 0]
+        chunk = chunk.assign(chromosome=chromosomes[chromosomes > 0])
+        if recode is not None:
+            chunk = recode(chunk)
+        res.append(chunk.values.astype(np.int64))
+    return np.concatenate(res)
+
+
+def split_chromosomes(arr):
+    """Group elements by chromosome, keeping their order within chromosomes
+
+    :param arr: int64 array with chromosome ids in the first column
+
+    :return: python dictionary of per chromosome views
+    """
+    arr = arr[np.argsort(arr[:, 0], kind="stable")]
+    offsets = np.searchsorted(arr[:, 0], np.arange(1, 26), side="left")
+    return {i: arr[offsets[i - 1]:offsets[i]] for i in range(1, 25)}
+
+
+def save_json(f, cd, dummies: int = 3):
+    """Save a per chromosome dictionary to a gzipped json file. Chromosomes without elements get a placeholder row
+
+    :param f: filepath
+    :param cd: per chromosome dictionary of numpy arrays
+    :param dummies: number of columns of placeholder rows
+    """
+    obj = {i: cd[i].tolist() if len(cd[i]) > 0 else [[PLACEHOLDER] * dummies] for i in range(1, 25)}
+    with gzip.open(f, 'w') as g:
+        g.write(json.dumps(obj).encode('utf-8'))
+
+
+def build_database(name: str, raw_dir: str, out_dir: str, chunksize: int = 1000000, save_as_json: bool = True):
+    """Build a single database
+
+    :param name: database name, one of SOURCES
+    :param raw_dir: directory of raw tables
+    :param out_dir: directory of preprocessed databases
+    :param chunksize: number of rows read at once
+    :param save_as_json: whether the database should be saved as gzipped json as well
+
+    :return: database name
+    """
+    from isv.annotate import save_data, WEIGHTS
+
+    filename, drop, recode, dummies = SOURCES[name]
+    with profiling.stage(f"build_{name}"):
+        cd = split_chromosomes(read_raw(os.path.join(raw_dir, filename), drop, recode, chunksize))
+        # json first, the binary format is used only if it is not older
+        if save_as_json:
+            save_json(os.path.join(out_dir, f"{name}.json.gz"), cd, dummies)
+        save_data(os.path.join(out_dir, f"{name}.npy"), cd)
+        # saved last, an index is used only if it is not older than the database
+        save_index(os.path.join(out_dir, f"{name}.index"), build_index(cd, WEIGHTS[name]))
+    return name
+
+
+def convert_database(name: str, out_dir: str):
+    """Convert a gzipped json database to the memory mappable binary format and save its interval index
+
+    :param name: database name, one of SOURCES
+    :param out_dir: directory of preprocessed databases, containing the gzipped json database
+
+    :return: database name
+    """
+    from isv.annotate import open_data, save_data, WEIGHTS
+
+    with profiling.stage(f"convert_{name}"):
+        cd = open_data(os.path.join(out_dir, f"{name}.json.gz"))
+        save_data(os.path.join(out_dir, f"{name}.npy"), cd)
+        save_index(os.path.join(out_dir, f"{name}.index"), build_index(cd, WEIGHTS[name]))
+    return name
+
+
+def _build_database(args):
+    if args[0] == "json":
+        return convert_database(*args[1:])
+    return build_database(*args[1:])
+
+
+def read_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def source_path(name: str, source: str, raw_dir: str, out_dir: str):
+    """Path to the table a database is built from
+
+    :param name: database name
+    :param source: either "raw" (raw table) or "json" (gzipped json database)
+    :param raw_dir: directory of raw tables
+    :param out_dir: directory of preprocessed databases
+
+    :return: filepath
+    """
+    if source == "json":
+        return os.path.join(out_dir, f"{name}.json.gz")
+    return os.path.join(raw_dir, SOURCES[name][0])
+
+
+def outdated(names, raw_dir: str, out_dir: str, source: str = "raw"):
+    """Databases whose source tables changed since they were built, or which were not built yet
+
+    :param names: database names
+    :param raw_dir: directory of raw tables
+    :param out_dir: directory of preprocessed databases
+    :param source: either "raw" (raw tables) or "json" (gzipped json databases)
+
+    :return: list of database names
+    """
+    manifest = read_manifest(out_dir)
+    res = []
+    for name in names:
+        entry = manifest.get(name, {})
+        if entry.get("version") != BUILD_VERSION \
+                or entry.get(source) != file_digest(source_path(name, source, raw_dir, out_dir)) \
+                or not os.path.exists(os.path.join(out_dir, f"{name}.npy")) \
+                or not os.path.isdir(os.path.join(out_dir, f"{name}.index")):
+            res.append(name)
+    return res
+
+
+def build_databases(names=None, raw_dir: str = None, out_dir: str = None, n_jobs: int = 1, incremental: bool = True,
+                    chunksize: int = 1000000, save_as_json: bool = True, from_json: bool = False):
+    """Build preprocessed annotation databases from raw tables, or convert gzipped json databases
+
+    :param names: database names (gencode_genes, hi_genes, hits_regions, regulatory). Defaults to all databases
+    :param raw_dir: directory of raw tables. Defaults to settings.data_dir/raw
+    :param out_dir: directory of preprocessed databases. Defaults to settings.data_dir/preprocessed
+    :param n_jobs: number of processes (-1 for all cores)
+    :param incremental: whether only databases whose raw tables changed should be rebuilt
+    :param chunksize: number of rows of raw tables read at once
+    :param save_as_json: whether databases should be saved as gzipped json as well
+    :param from_json: convert gzipped json databases in out_dir (e.g. the shipped ones) to the binary format and \
+    save their interval indexes, instead of building from raw tables. incremental then compares digests of the json \
+    databases
+
+    :return: list of rebuilt databases
+    """
+    from isv.annotate import clear_databases
+    from isv.scripts.parallel import n_processes, get_context, _init_worker
+
+    if names is None:
+        names = list(SOURCES)
+    if raw_dir is None:
+        raw_dir = os.path.join(settings.data_dir, "raw")
+    if out_dir is None:
+        out_dir = os.path.join(settings.data_dir, "preprocessed")
+    os.makedirs(out_dir, exist_ok=True)
+
+    source = "json" if from_json else "raw"
+    if incremental:
+        names = outdated(names, raw_dir, out_dir, source)
+
+    if from_json:
+        args = [("json", name, out_dir) for name in names]
+    else:
+        args = [("raw", name, raw_dir, out_dir, chunksize, save_as_json) for name in names]
+    n_jobs = min(n_processes(n_jobs), len(args))
+    if n_jobs <= 1:
+        built = [_build_database(a) for a in args]
+    else:
+        with get_context().Pool(n_jobs, initializer=_init_worker, initargs=(dict(vars(settings)),)) as pool:
+            built = pool.map(_build_database, args)
+
+    manifest = read_manifest(out_dir)
+    for name in built:
+        entry = {"version": BUILD_VERSION, source: file_digest(source_path(name, source, raw_dir, out_dir))}
+        if source == "raw" and save_as_json:
+            # json written by this build does not have to be converted again
+            entry["json"] = file_digest(source_path(name, "json", raw_dir, out_dir))
+        manifest[name] = entry
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if built:
+        clear_databases()
+
+    return built
+
+
+def main(argv=None):
+    """Command line interface of build_databases, see preprocess_data.py"""
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser("Build preprocessed annotation databases")
+
+    parser.add_argument("-d", "--databases", required=False, nargs="+", choices=list(SOURCES), default=None,
+                        help="databases to build. Defaults to all databases")
+    parser.add_argument("-r", "--raw-dir", required=False, type=str, default=None,
+                        help="directory of raw tables. Defaults to isv/data/raw")
+    parser.add_argument("-o", "--output-dir", required=False, type=str, default=None,
+                        help="directory of preprocessed databases. Defaults to isv/data/preprocessed")
+    parser.add_argument("-j", "--n-jobs", required=False, type=int, default=1,
+                        help="number of processes (-1 for all cores)")
+    parser.add_argument("-c", "--chunksize", required=False, type=int, default=1000000,
+                        help="number of rows of raw tables read at once")
+    parser.add_argument("--full", required=False, action="store_true",
+                        help="rebuild all databases, not only those whose source tables changed")
+    parser.add_argument("--no-json", required=False, action="store_true",
+                        help="save databases only in the binary format, not as gzipped json")
+    parser.add_argument("--from-json", required=False, action="store_true",
+                        help="convert gzipped json databases of the output directory (e.g. the shipped ones) to the "
+                             "binary format and index them, instead of building from raw tables")
+
+    args = parser.parse_args(argv)
+
+    built = build_databases(args.databases, args.raw_dir, args.output_dir, n_jobs=args.n_jobs,
+                            incremental=not args.full, chunksize=args.chunksize, save_as_json=not args.no_json,
+                            from_json=args.from_json)
+
+    print(f"Rebuilt: {', '.join(built)}" if built else "All databases are up to date")
+
+
+if __name__ == "__main__":
+    main()
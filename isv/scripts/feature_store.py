@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Store of annotated and scaled feature matrices of CNV sets
+
+Matrices are saved as .npy files named by a digest of the CNV coordinates, the cnv type and the contents of the
+files they depend on (preprocessed databases, scaler and training data), so retraining experiments on the same CNVs
+do not annotate them again, and matrices are never reused after databases or scalers change.
+"""
+import hashlib
+import os
+import uuid
+
+import numpy as np
+
+from isv.config import settings
+from isv.scripts import profiling
+from isv.scripts.result_cache import file_digest, version
+
+# dtype of stored matrices, models evaluate float32 features
+DTYPE = np.float32
+
+_feature_store = None
+
+
+def feature_key(cnvs, cnv_type: str):
+    """Content address of the feature matrix of a CNV set
+
+    :param cnvs: dataframe with chromosome, start, end and cnv_type columns
+    :param cnv_type: type of cnv, "loss" or "gain"
+
+    :return: hex digest
+    """
+    h = hashlib.sha1(f"{cnv_type}:{np.dtype(DTYPE).str}:{version('annotation')}".encode("utf-8"))
+    for path in [os.path.join(settings.model_dir, f"scaler_{cnv_type}.json"),
+                 os.path.join(settings.data_dir, f"train_{cnv_type}.tsv.gz")]:
+        h.update(file_digest(path).encode("utf-8"))
+
+    h.update("\n".join(cnvs.iloc[:, 0].astype(str)).encode("utf-8"))
+    for j in [1, 2]:
+        h.update(np.ascontiguousarray(cnvs.iloc[:, j].values, dtype=np.int64).tobytes())
+    h.update("\n".join(cnvs.iloc[:, 3].astype(str)).encode("utf-8"))
+    return h.hexdigest()
+
+
+class FeatureStore:
+    """Directory of feature matrices
+
+    :param path: directory, created if it does not exist
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.npy")
+
+    def get(self, key):
+        """Stored matrix, memory mapped, or None"""
+        f = self._file(key)
+        if not os.path.exists(f):
+            return None
+        return np.load(f, mmap_mode="r")
+
+    def set(self, key, X):
+        """Store a matrix. Written to a temporary file first, so that concurrent readers never see partial files"""
+        tmp = os.path.join(self.path, f".{key}.{uuid.uuid4().hex}.npy")
+        np.save(tmp, np.asarray(X, dtype=DTYPE))
+        os.replace(tmp, self._file(key))
+
+
+def enable_feature_store(path: str):
+    """Store annotated and scaled feature matrices of isv.alternative.alternative_data
+
+    :param path: directory of stored matrices
+    """
+    global _feature_store
+    _feature_store = FeatureStore(path)
+
+
+def disable_feature_store():
+    """Stop storing feature matrices"""
+    global _feature_store
+    _feature_store = None
+
+
+def scaled_features(cnvs, cnv_type: str):
+    """Annotated and scaled features of CNVs, reused from the feature store if enabled
+
+    :param cnvs: dataframe of CNVs with the same cnv type
+    :param cnv_type: type of cnv, "loss" or "gain"
+
+    :return: float32 array with one row per CNV, in the order of attributes of the cnv type
+    """
+    from isv.annotate import annotate
+    from isv.scripts.prepare_df import prepare
+
+    if _feature_store is not None:
+        key = feature_key(cnvs, cnv_type)
+        X = _feature_store.get(key)
+        if X is not None:
+            profiling.count("feature_store_hits", len(X))
+            return X
+
+    X = prepare(annotate(cnvs.copy()), cnv_type, dtype=DTYPE)
+
+    if _feature_store is not None:
+        _feature_store.set(key, X)
+    return X
@@ -2,10 +2,44 @@ import pandas as pd
 import numpy as np
 
 
+def is_arrow(obj):
+    """Whether obj is a pyarrow Table or RecordBatch, without importing pyarrow"""
+    return type(obj).__module__.startswith("pyarrow") and hasattr(obj, "to_pandas")
+
+
+def from_arrow(table):
+    """Convert an arrow table of CNVs to a pandas dataframe
+
+    Numeric columns without missing values are not copied. Strings (chromosomes and cnv types) become categoricals, \
+    so that each distinct value is converted only once
+
+    :param table: pyarrow Table or RecordBatch
+
+    :return: pandas dataframe
+    """
+    return table.to_pandas(split_blocks=True, strings_to_categorical=True)
+
+
 def check_cnvs_obj(cnvs):
     if isinstance(cnvs, list) or isinstance(cnvs, np.ndarray):
         cnvs = pd.DataFrame(cnvs)
-    assert isinstance(cnvs, pd.core.frame.DataFrame), "Input should be either list, np.ndarray or pd.DataFrame"
+    elif is_arrow(cnvs):
+        cnvs = from_arrow(cnvs)
+    assert isinstance(cnvs, pd.core.frame.DataFrame), \
+        "Input should be either list, np.ndarray, pd.DataFrame or pyarrow.Table"
     assert cnvs.shape[1] == 4, "Input should have 4 columns: chromosome, start (GRCh38), end (GRCh38), cnv_type"
     assert sum(i not in ["DUP", "DEL"] for i in cnvs.iloc[:, 3]) == 0, "only 'DEL' and 'DUP' cnv_type values allowed"
     return cnvs
+
+
+def select_rows(df, ind):
+    """Select rows at given positions, without copying the dataframe if all rows are selected in order
+
+    :param df: pandas dataframe
+    :param ind: sorted array of row positions
+
+    :return: pandas dataframe
+    """
+    if len(ind) == len(df):
+        return df
+    return df.iloc[ind]
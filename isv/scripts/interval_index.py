@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sorted interval index for counting overlapped genomic elements
+
+For elements with start <= end and a query with start <= end, an element overlaps the query
+iff element_start <= end and element_end >= start. Elements with element_end < start are a subset
+of those with element_start <= end, so the (weighted) number of overlapped elements is
+
+    W(element_start <= end) - W(element_end < start)
+
+where both terms are prefix sums over elements sorted by start and by end respectively. Each
+query is therefore answered with two binary searches per chromosome.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+import numba as nb
+
+# placeholder value used by preprocess_data.py for chromosomes without any elements
+PLACEHOLDER = -1618
+
+IntervalIndex = namedtuple("IntervalIndex", ["offsets", "starts", "ends", "start_order_ends",
+                                             "start_cum", "end_cum"])
+IntervalIndex.__doc__ = """Flat, per-chromosome sorted interval index
+
+Rows of chromosome ``c`` live in ``offsets[c]:offsets[c + 1]``.
+
+:param offsets: int64 array of length 26 with chromosome offsets
+:param starts: element starts, sorted within each chromosome
+:param ends: element ends, sorted within each chromosome
+:param start_order_ends: element ends in the order of ``starts``
+:param start_cum: cumulative weights (int32, shape (n + 1, k)) of elements sorted by start
+:param end_cum: cumulative weights (int32, shape (n + 1, k)) of elements sorted by end
+"""
+
+
+def build_index(cd, weights):
+    """Build an interval index from a per chromosome dictionary
+
+    :param cd: dictionary of numpy arrays (chromosome, start, end, ...) as returned by open_data
+    :param weights: function mapping an array of elements to an (n, k) array of per element weights
+
+    :return: IntervalIndex
+    """
+    offsets = np.zeros(26, dtype=np.int64)
+    starts, ends, start_order_ends, start_w, end_w = [], [], [], [], []
+
+    # drop placeholders of chromosomes without elements
+    cd = {c: cd[c][~np.all(cd[c] == PLACEHOLDER, axis=1)] for c in range(1, 25)}
+    w = {c: np.asarray(weights(cd[c]), dtype=np.int32).reshape(len(cd[c]), -1) for c in cd if len(cd[c]) > 0}
+    k = next(iter(w.values())).shape[1]
+
+    for c in range(1, 25):
+        arr = cd[c]
+        assert np.all(arr[:, 1] <= arr[:, 2]), "element start has to be lower or equal to its end"
+        arr_w = w.get(c, np.zeros((0, k), dtype=np.int32))
+
+        start_order = np.argsort(arr[:, 1], kind="stable")
+        end_order = np.argsort(arr[:, 2], kind="stable")
+
+        starts.append(arr[start_order, 1])
+        ends.append(arr[end_order, 2])
+        start_order_ends.append(arr[start_order, 2])
+        start_w.append(arr_w[start_order])
+        end_w.append(arr_w[end_order])
+
+        offsets[c + 1] = offsets[c] + len(arr)
+
+    start_cum = np.zeros((offsets[25] + 1, k), dtype=np.int32)
+    end_cum = np.zeros((offsets[25] + 1, k), dtype=np.int32)
+    np.cumsum(np.concatenate(start_w), axis=0, out=start_cum[1:])
+    np.cumsum(np.concatenate(end_w), axis=0, out=end_cum[1:])
+
+    return IntervalIndex(offsets,
+                         np.concatenate(starts).astype(np.int64),
+                         np.concatenate(ends).astype(np.int64),
+                         np.concatenate(start_order_ends).astype(np.int64),
+                         start_cum,
+                         end_cum)
+
+
+def save_index(path, index):
+    """Save an interval index as a directory of .npy files, one per field
+
+    :param path: directory, created if it does not exist
+    :param index: IntervalIndex
+    """
+    os.makedirs(path, exist_ok=True)
+    for field, arr in zip(IntervalIndex._fields, index):
+        np.save(os.path.join(path, f"{field}.npy"), arr)
+
+
+def open_index(path):
+    """Open an interval index saved by save_index
+
+    Arrays are memory mapped copy-on-write, so processes share their pages through the page cache and nothing is
+    sorted or summed again.
+
+    :param path: directory of the index
+
+    :return: IntervalIndex
+    """
+    return IntervalIndex(*(np.asarray(np.load(os.path.join(path, f"{field}.npy"), mmap_mode="c"))
+                           for field in IntervalIndex._fields))
+
+
+@nb.jit(nopython=True, cache=True)
+def count_overlaps_into(out, index, chrom: int, start: int, end: int):
+    """Write weighted counts of elements overlapped by the start, end positions into out
+
+    :param out: output array with as many items as there are weight columns in the index
+    :param index: IntervalIndex
+    :param chrom: chromosome number (1-24)
+    :param start: start position
+    :param end: end position
+    """
+    lo = index.offsets[chrom]
+    hi = index.offsets[chrom + 1]
+
+    # number of elements on the chromosome with element_start <= end
+    a = lo + np.searchsorted(index.starts[lo:hi], end, side="right")
+
+    if start <= end:
+        # number of elements on the chromosome with element_end < start
+        b = lo + np.searchsorted(index.ends[lo:hi], start, side="left")
+        for j in range(out.shape[0]):
+            out[j] = index.start_cum[a, j] - index.end_cum[b, j]
+        return
+
+    # inverted coordinates: the prefix identity does not hold, scan elements with element_start <= end
+    out[:] = 0
+    for i in range(lo, a):
+        if index.start_order_ends[i] >= start:
+            for j in range(out.shape[0]):
+                out[j] += index.start_cum[i + 1, j] - index.start_cum[i, j]
+
+
+@nb.jit(nopython=True, cache=True)
+def count_overlaps(index, chrom: int, start: int, end: int):
+    """Weighted counts of elements overlapped by the start, end positions
+
+    :param index: IntervalIndex
+    :param chrom: chromosome number (1-24)
+    :param start: start position
+    :param end: end position
+
+    :return: array of summed weights of overlapped elements
+    """
+    out = np.empty(index.start_cum.shape[1], dtype=np.int64)
+    count_overlaps_into(out, index, chrom, start, end)
+    return out
+
+
+@nb.jit(nopython=True, cache=True)
+def sweep_overlaps_into(out, index, chrom: int, first_start: int, step: int, size: int):
+    """Write weighted counts of elements overlapped by consecutive windows of a tiling grid into out
+
+    Windows start at first_start + i * step and have the same size, so their starts and ends both increase and
+    the binary searches of count_overlaps_into become two pointers sweeping over the elements of the chromosome.
+
+    :param out: output array of shape (number of windows, number of weight columns of the index)
+    :param index: IntervalIndex
+    :param chrom: chromosome number (1-24)
+    :param first_start: start of the first window
+    :param step: distance between starts of consecutive windows (> 0)
+    :param size: window size (> 0), windows end at start + size - 1
+    """
+    lo = index.offsets[chrom]
+    hi = index.offsets[chrom + 1]
+
+    # elements with element_start <= end, and with element_end < start
+    a = lo + np.searchsorted(index.starts[lo:hi], first_start + size - 1, side="right")
+    b = lo + np.searchsorted(index.ends[lo:hi], first_start, side="left")
+    for i in range(out.shape[0]):
+        start = first_start + i * step
+        end = start + size - 1
+        while a < hi and index.starts[a] <= end:
+            a += 1
+        while b < hi and index.ends[b] < start:
+            b += 1
+        for j in range(out.shape[1]):
+            out[i, j] = index.start_cum[a, j] - index.end_cum[b, j]
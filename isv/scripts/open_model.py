@@ -1,7 +1,10 @@
 import json
 import gzip
-from sklearn_json import from_json, from_dict
-import xgboost as xgb
+import os
+from functools import lru_cache
+
+from isv.config import settings
+from isv.scripts import profiling
 
 
 def open_model(model_path):
@@ -12,6 +15,8 @@ def open_model(model_path):
     :return: model
     """
     if model_path.endswith('gz'):
+        from sklearn_json import from_dict
+
         with gzip.open(model_path, 'r') as f:
             model = f.read()
             model = json.loads(model.decode('utf-8'))
@@ -23,10 +28,35 @@ def open_model(model_path):
             a = f.readline()
 
         if a.startswith('{"learner"'):
+            import xgboost as xgb
+
             model = xgb.Booster()
             model.load_model(model_path)
             return model
 
         else:
+            from sklearn_json import from_json
+
             model = from_json(model_path)
             return model
+
+
+def load_model(cnv_type):
+    """Return the ISV model for given cnv type. Model is opened once and cached in memory
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: model
+    """
+    return _load_model(os.path.join(settings.model_dir, f'ISV_{cnv_type}.json'))
+
+
+@lru_cache(maxsize=None)
+def _load_model(model_path):
+    with profiling.stage("load_model"):
+        return open_model(model_path)
+
+
+def clear_models():
+    """Remove cached models"""
+    _load_model.cache_clear()
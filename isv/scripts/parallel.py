@@ -0,0 +1,124 @@
+import atexit
+import multiprocessing as mp
+import os
+from functools import partial
+
+import numba as nb
+import numpy as np
+
+from isv.config import settings
+
+
+def n_processes(n_jobs: int):
+    """Number of worker processes for n_jobs. Negative values count back from the number of cores (-1 = all)
+
+    :param n_jobs: requested number of jobs
+
+    :return: number of processes
+    """
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def get_context():
+    """Multiprocessing context for worker processes
+
+    Forked workers share databases, models and explainers loaded in the parent process read-only. The GNU OpenMP
+    runtime of the omp threading layer of numba is not fork safe. The tbb layer is fork safe for the children, but
+    a parent which forked after its TBB thread pool started hangs on interpreter exit. Once numba launched either
+    thread pool (and on platforms without fork) workers are therefore spawned and load what they need themselves.
+    The workqueue layer is fork safe.
+
+    :return: multiprocessing context
+    """
+    if 'fork' in mp.get_all_start_methods():
+        try:
+            layer = nb.threading_layer()
+        except ValueError:
+            # no parallel kernel was launched yet
+            layer = None
+
+        if layer not in ['omp', 'tbb']:
+            return mp.get_context('fork')
+
+    return mp.get_context('spawn')
+
+
+def _init_worker(settings_dict):
+    settings.__dict__.update(settings_dict)
+    # parallelism comes from the pool, keep numba kernels in workers single threaded
+    nb.set_num_threads(1)
+
+
+def _init_pool_worker(settings_dict):
+    from isv.scripts.open_model import load_model
+    from isv.scripts.prepare_df import load_scaler
+    from isv.scripts.tree_ensemble import load_tree_ensemble
+
+    _init_worker(settings_dict)
+    # loaded once per worker, the pool outlives calls
+    for cnv_type in ["loss", "gain"]:
+        if settings.predict_backend == "numba":
+            load_tree_ensemble(cnv_type)
+        else:
+            load_model(cnv_type)
+        load_scaler(cnv_type)
+
+
+_pool = None
+_pool_size = 0
+_pool_settings = None
+
+
+def get_pool(n_jobs: int):
+    """Process pool with at least n_jobs workers, created once and reused by later calls
+
+    Workers are started (forked or spawned, see get_context) with the settings of the caller and load models and
+    scalers once, explainers on first use. The pool is recreated only when more workers are requested or settings
+    changed, and it is terminated by shutdown_pool or on interpreter exit.
+
+    :param n_jobs: number of processes
+
+    :return: multiprocessing pool
+    """
+    global _pool, _pool_size, _pool_settings
+
+    settings_dict = dict(vars(settings))
+    if _pool is None or _pool_size < n_jobs or _pool_settings != settings_dict:
+        shutdown_pool()
+        _pool = get_context().Pool(n_jobs, initializer=_init_pool_worker, initargs=(settings_dict,))
+        _pool_size, _pool_settings = n_jobs, settings_dict
+    return _pool
+
+
+def shutdown_pool():
+    """Terminate the worker pool of get_pool, if any"""
+    global _pool, _pool_size, _pool_settings
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool, _pool_size, _pool_settings = None, 0, None
+
+
+atexit.register(shutdown_pool)
+
+
+def map_chunks(fun, data, n_jobs: int, **kwargs):
+    """Apply function to contiguous chunks of data in the process pool of get_pool
+
+    :param fun: function applied to each chunk
+    :param data: pandas dataframe
+    :param n_jobs: number of processes
+    :param kwargs: keyword arguments passed to fun
+
+    :return: list of results in the order of chunks
+    """
+    n_jobs = n_processes(n_jobs)
+    chunks = [data.iloc[ind] for ind in np.array_split(np.arange(len(data)), n_jobs) if len(ind) > 0]
+
+    if len(chunks) <= 1:
+        return [fun(chunk, **kwargs) for chunk in chunks]
+
+    return get_pool(n_jobs).map(partial(fun, **kwargs), chunks)
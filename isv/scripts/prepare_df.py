@@ -1,46 +1,189 @@
-import pandas as pd
+import json
 import os
-from sklearn.preprocessing import RobustScaler
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
 
 from isv.scripts.constants import LOSS_ATTRIBUTES, GAIN_ATTRIBUTES
 from isv.config import settings
+from isv.scripts import profiling
 
 
-def prepare(X, cnv_type, return_train=False):
-    """
-    Extract relevant attributes for training and return training dataset
-    together with labels, and scale the dataset - do same for validation dataset
+def normalize_cnv_type(cnv_type):
+    """Translate cnv type to either "loss" or "gain"
 
-    :param cnv_type: type of the cnv == ["loss", "gain"]
-    :param X: pandas dataframe
-    :param return_train: specify if transformed train data should be returned
+    :param cnv_type: type of the cnv == ["loss", "gain", "del", "dup"]
 
-    :return X: transformed dataframe if return_train is False. else tuple (X, X_train)
+    :return: tuple (cnv_type, attributes)
     """
     cnv_type = cnv_type.lower()
     assert cnv_type in ['loss', 'gain', 'del', 'dup'], 'unknown cnv type'
     if cnv_type in ['loss', 'del']:
-        cnv_type = 'loss'
-        attributes = LOSS_ATTRIBUTES
-    elif cnv_type in ['gain', 'dup']:
-        cnv_type = 'gain'
-        attributes = GAIN_ATTRIBUTES
+        return 'loss', LOSS_ATTRIBUTES
+    return 'gain', GAIN_ATTRIBUTES
 
+
+def read_train(cnv_type):
+    """Read unscaled training data
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: numpy array of training attributes
+    """
+    cnv_type, attributes = normalize_cnv_type(cnv_type)
     train_data_path = os.path.join(settings.data_dir, f'train_{cnv_type}.tsv.gz')
     X_train = pd.read_csv(train_data_path, compression='gzip', sep='\t')
+    return X_train.loc[:, attributes].values
+
+
+def fit_scaler(cnv_type):
+    """Fit a RobustScaler on training data
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
 
-    # Train
-    X_train = X_train.loc[:, attributes]
+    :return: tuple (center, scale)
+    """
+    from sklearn.preprocessing import RobustScaler
+
+    scaler = RobustScaler().fit(read_train(cnv_type))
+    return scaler.center_, scaler.scale_
+
+
+def save_scaler(cnv_type):
+    """Fit a RobustScaler on training data and save its parameters next to the models
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+    """
+    cnv_type, attributes = normalize_cnv_type(cnv_type)
+    center, scale = fit_scaler(cnv_type)
+    with open(os.path.join(settings.model_dir, f'scaler_{cnv_type}.json'), 'w') as f:
+        json.dump({'attributes': attributes, 'center': center.tolist(), 'scale': scale.tolist()}, f, indent=1)
+
+
+def save_background(cnv_type, size: int = 100):
+    """Draw a sample of training data stratified by clinical significance and save it next to the models
+
+    The sample is used as a summarized background dataset for SHAP values.
 
-    # evaluated data
-    X_any = X.loc[:, attributes]
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+    :param size: number of sampled CNVs
+    """
+    cnv_type, attributes = normalize_cnv_type(cnv_type)
+    train_data_path = os.path.join(settings.data_dir, f'train_{cnv_type}.tsv.gz')
+    train = pd.read_csv(train_data_path, compression='gzip', sep='\t')
+
+    rng = np.random.default_rng(1618)
+    ind = np.concatenate([
+        rng.choice(np.where(train.clinsig == c)[0], int(round(size * np.mean(train.clinsig == c))), replace=False)
+        for c in [0, 1]])
+
+    with open(os.path.join(settings.model_dir, f'background_{cnv_type}.json'), 'w') as f:
+        json.dump({'attributes': attributes, 'data': train.loc[:, attributes].values[np.sort(ind)].tolist()}, f)
+
+
+def load_background(cnv_type):
+    """Return scaled background sample saved by save_background. Result is cached in memory
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: numpy array
+    """
+    cnv_type, _ = normalize_cnv_type(cnv_type)
+    return _load_background(cnv_type, settings.model_dir, settings.data_dir)
+
+
+@lru_cache(maxsize=None)
+def _load_background(cnv_type, model_dir, data_dir):
+    with open(os.path.join(model_dir, f'background_{cnv_type}.json'), 'r') as f:
+        background = np.array(json.load(f)['data'])
+
+    center, scale = load_scaler(cnv_type)
+    background = (background - center) / scale
+    background.setflags(write=False)
+    return background
+
+
+def load_scaler(cnv_type):
+    """Return parameters of the scaler for given cnv type
+
+    Parameters are read from the models directory, or fitted on training data if they were not saved.
+    Result is cached in memory.
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: tuple (center, scale)
+    """
+    cnv_type, _ = normalize_cnv_type(cnv_type)
+    return _load_scaler(cnv_type, settings.model_dir, settings.data_dir)
+
+
+@lru_cache(maxsize=None)
+def _load_scaler(cnv_type, model_dir, data_dir):
+    scaler_path = os.path.join(model_dir, f'scaler_{cnv_type}.json')
+    with profiling.stage("load_scaler"):
+        if os.path.exists(scaler_path):
+            with open(scaler_path, 'r') as f:
+                params = json.load(f)
+            center, scale = np.array(params['center']), np.array(params['scale'])
+        else:
+            center, scale = fit_scaler(cnv_type)
+
+    center.setflags(write=False)
+    scale.setflags(write=False)
+    return center, scale
+
+
+def load_train(cnv_type):
+    """Return scaled training data for given cnv type. Result is cached in memory
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: numpy array
+    """
+    cnv_type, _ = normalize_cnv_type(cnv_type)
+    return _load_train(cnv_type, settings.model_dir, settings.data_dir)
+
+
+@lru_cache(maxsize=None)
+def _load_train(cnv_type, model_dir, data_dir):
+    center, scale = load_scaler(cnv_type)
+    X_train = (read_train(cnv_type) - center) / scale
+    X_train.setflags(write=False)
+    return X_train
+
+
+def clear_scalers():
+    """Remove cached scalers, training data and background samples"""
+    _load_scaler.cache_clear()
+    _load_train.cache_clear()
+    _load_background.cache_clear()
+
+
+def prepare(X, cnv_type, return_train=False, dtype=np.float64):
+    """
+    Extract relevant attributes for training and return training dataset
+    together with labels, and scale the dataset - do same for validation dataset
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+    :param X: pandas dataframe
+    :param return_train: specify if transformed train data should be returned
+    :param dtype: dtype of the transformed data. Values are scaled in float64 either way, so float32 output \
+    equals float64 output rounded to float32
+
+    :return X: transformed dataframe if return_train is False. else tuple (X, X_train)
+    """
+    cnv_type, attributes = normalize_cnv_type(cnv_type)
 
-    # Scale
-    scaler = RobustScaler()
-    X_train = scaler.fit_transform(X_train)
-    X_any = scaler.transform(X_any)
+    # Scale evaluated data
+    center, scale = load_scaler(cnv_type)
+    with profiling.stage("scale"):
+        # column by column, so that neither the selected columns nor float64 intermediates are materialized
+        X_any = np.empty((len(X), len(attributes)), dtype=dtype)
+        for j, attribute in enumerate(attributes):
+            X_any[:, j] = (X[attribute].values - center[j]) / scale[j]
 
     if return_train:
-        return X_any, X_train
+        return X_any, load_train(cnv_type)
 
     return X_any
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage timers and counters of the ISV pipeline
+
+The pipeline reports events:
+
+- ``{"type": "stage", "name": ..., "seconds": ...}`` when a stage (e.g. "annotate", "predict") finishes
+- ``{"type": "counter", "name": ..., "value": ...}`` when a counter (e.g. "cnvs_annotated") is incremented
+
+Events are passed to registered callbacks and logged at DEBUG level to the "isv" logger. Nothing is reported by
+default, and without callbacks or debug logging, instrumented code only pays for a single check per event.
+Events of worker processes (n_jobs > 1) are not reported.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("isv")
+
+_callbacks = []
+
+
+def add_callback(callback):
+    """Register a function called with every event
+
+    :param callback: function accepting an event dictionary
+    """
+    _callbacks.append(callback)
+
+
+def remove_callback(callback):
+    """Unregister a callback
+
+    :param callback: previously registered function
+    """
+    _callbacks.remove(callback)
+
+
+def enabled():
+    """Whether events are reported, so that expensive counters can be skipped otherwise"""
+    return bool(_callbacks) or logger.isEnabledFor(logging.DEBUG)
+
+
+def emit(event):
+    """Report an event to callbacks and the logger
+
+    :param event: event dictionary
+    """
+    for callback in list(_callbacks):
+        callback(event)
+    logger.debug("%s", event)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the pipeline
+
+    :param name: name of the stage
+    """
+    if not enabled():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit({"type": "stage", "name": name, "seconds": time.perf_counter() - start})
+
+
+def count(name, value):
+    """Increment a counter
+
+    :param name: name of the counter
+    :param value: increment
+    """
+    if enabled():
+        emit({"type": "counter", "name": name, "value": value})
+
+
+class Profile:
+    """Callback accumulating stage timings and counters"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    def __call__(self, event):
+        if event["type"] == "stage":
+            calls, seconds = self.stages.get(event["name"], (0, 0.0))
+            self.stages[event["name"]] = (calls + 1, seconds + event["seconds"])
+        else:
+            self.counters[event["name"]] = self.counters.get(event["name"], 0) + event["value"]
+
+    def to_dict(self):
+        """:return: dictionary of stages (calls and total seconds) and counters"""
+        return {
+            "stages": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def report(self):
+        """:return: human readable table of stages and counters"""
+        lines = [f"{'stage':<24}{'calls':>8}{'seconds':>12}"]
+        lines += [f"{name:<24}{calls:>8}{seconds:>12.4f}" for name, (calls, seconds) in self.stages.items()]
+        lines += ["", f"{'counter':<24}{'value':>20}"]
+        lines += [f"{name:<24}{value:>20}" for name, value in self.counters.items()]
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile():
+    """Collect events reported within the block
+
+    :return: Profile
+    """
+    p = Profile()
+    add_callback(p)
+    try:
+        yield p
+    finally:
+        remove_callback(p)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of annotations, probabilities and SHAP values keyed by CNV coordinates
+
+Entries are stored with a version derived from the contents of the files they depend on (preprocessed databases,
+models, scalers and SHAP backgrounds), so they are invalidated automatically when any of these files change.
+The cache has an in-memory LRU tier and an optional on-disk SQLite tier.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from isv.config import settings
+from isv.scripts import profiling
+
+COORDINATES = ["chrom", "start", "end", "cnv_type"]
+
+# dtype of cached values of each kind
+DTYPES = {"annotation": np.int32, "proba": np.float64, "shap_full": np.float64, "shap_sample": np.float64,
+          "shap_approximate": np.float64, "shap_approximate_log_odds": np.float64,
+          "shap_xgboost": np.float64, "shap_xgboost_log_odds": np.float64}
+
+_result_cache = None
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path, size, mtime_ns):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """Digest of file contents, recomputed only when its size or modification time changes
+
+    :param path: filepath
+
+    :return: hex digest, or "missing" if the file does not exist
+    """
+    if not os.path.exists(path):
+        return "missing"
+    st = os.stat(path)
+    return _file_digest(path, st.st_size, st.st_mtime_ns)
+
+
+def version(kind):
+    """Version of cached values of given kind
+
+    :param kind: one of DTYPES, e.g. "annotation", "proba", "shap_full" or "shap_sample"
+
+    :return: version string
+    """
+    from isv.annotate import database_path
+
+    paths = [database_path(name) for name in ["gencode_genes", "regulatory", "hi_genes", "hits_regions"]]
+    if kind != "annotation":
+        paths += [os.path.join(settings.model_dir, f"{prefix}_{cnv_type}.json")
+                  for prefix in ["ISV", "scaler"] for cnv_type in ["loss", "gain"]]
+    if kind == "shap_full":
+        paths += [os.path.join(settings.data_dir, f"train_{cnv_type}.tsv.gz") for cnv_type in ["loss", "gain"]]
+    if kind == "shap_sample":
+        paths += [os.path.join(settings.model_dir, f"background_{cnv_type}.json") for cnv_type in ["loss", "gain"]]
+
+    h = hashlib.sha1(f"{kind}:{np.dtype(DTYPES[kind]).str}".encode("utf-8"))
+    for path in paths:
+        h.update(file_digest(path).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Two tier cache of per CNV results
+
+    :param path: path to the SQLite file of the on-disk tier. If None, only the in-memory tier is used
+    :param memory_size: maximum number of entries in the in-memory tier
+    """
+
+    def __init__(self, path: str = None, memory_size: int = 100000):
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (kind TEXT, version TEXT, chrom TEXT, "
+                            "cnv_start INTEGER, cnv_end INTEGER, cnv_type TEXT, value BLOB, "
+                            "PRIMARY KEY (kind, version, chrom, cnv_start, cnv_end, cnv_type)) WITHOUT ROWID")
+            self.db.execute("CREATE TEMP TABLE query (i INTEGER, chrom TEXT, cnv_start INTEGER, cnv_end INTEGER, "
+                            "cnv_type TEXT)")
+            self.prune()
+
+    def prune(self):
+        """Delete on-disk entries of outdated versions"""
+        if self.db is None:
+            return
+        with self.lock:
+            for kind in DTYPES:
+                self.db.execute("DELETE FROM results WHERE kind = ? AND version != ?", (kind, version(kind)))
+            self.db.commit()
+
+    def get_many(self, kind, version, keys):
+        """Look up cached values
+
+        :param kind: kind of values
+        :param version: version of values
+        :param keys: list of (chrom, start, end, cnv_type) tuples
+
+        :return: list of numpy arrays, None for missing entries
+        """
+        values = [None] * len(keys)
+        with self.lock:
+            for i, key in enumerate(keys):
+                value = self.memory.get((kind, version) + key)
+                if value is not None:
+                    self.memory.move_to_end((kind, version) + key)
+                    values[i] = value
+
+            missing = [i for i, v in enumerate(values) if v is None]
+            if self.db is not None and missing:
+                self.db.execute("DELETE FROM query")
+                self.db.executemany("INSERT INTO query VALUES (?, ?, ?, ?, ?)", [(i,) + keys[i] for i in missing])
+                rows = self.db.execute(
+                    "SELECT q.i, r.value FROM query q JOIN results r ON r.kind = ? AND r.version = ? "
+                    "AND r.chrom = q.chrom AND r.cnv_start = q.cnv_start AND r.cnv_end = q.cnv_end "
+                    "AND r.cnv_type = q.cnv_type", (kind, version))
+                for i, value in rows:
+                    values[i] = np.frombuffer(value, dtype=DTYPES[kind])
+                    self._remember((kind, version) + keys[i], values[i])
+
+        return values
+
+    def set_many(self, kind, version, keys, values):
+        """Store values
+
+        :param kind: kind of values
+        :param version: version of values
+        :param keys: list of (chrom, start, end, cnv_type) tuples
+        :param values: array with one row per key
+        """
+        values = np.asarray(values, dtype=DTYPES[kind]).reshape(len(keys), -1)
+        with self.lock:
+            for key, value in zip(keys, values):
+                self._remember((kind, version) + key, value)
+
+            if self.db is not None:
+                self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(kind, version) + key + (value.tobytes(),) for key, value in zip(keys, values)])
+                self.db.commit()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def enable_result_cache(path: str = None, memory_size: int = 100000):
+    """Cache annotations, probabilities and SHAP values of CNVs
+
+    :param path: path to a SQLite file for the persistent tier. If None, results are cached in memory only
+    :param memory_size: maximum number of entries kept in memory
+    """
+    global _result_cache
+    disable_result_cache()
+    _result_cache = ResultCache(path, memory_size)
+
+
+def disable_result_cache():
+    """Stop caching results and close the on-disk tier"""
+    global _result_cache
+    if _result_cache is not None:
+        _result_cache.close()
+    _result_cache = None
+
+
+def cached_rows(kind, cnvs, compute):
+    """Compute per CNV results, reusing cached rows
+
+    :param kind: one of DTYPES, e.g. "annotation", "proba", "shap_full" or "shap_sample"
+    :param cnvs: dataframe with chrom, start, end and cnv_type columns
+    :param compute: function computing an array with one row per CNV of a dataframe
+
+    :return: array with one row per CNV
+    """
+    if _result_cache is None or len(cnvs) == 0 or any(c not in cnvs.columns for c in COORDINATES):
+        return compute(cnvs)
+
+    v = version(kind)
+    keys = list(zip(cnvs.chrom.astype(str), cnvs.start.astype(np.int64).tolist(),
+                    cnvs.end.astype(np.int64).tolist(), cnvs.cnv_type.astype(str)))
+    values = _result_cache.get_many(kind, v, keys)
+
+    missing = [i for i, value in enumerate(values) if value is None]
+    profiling.count("result_cache_hits", len(keys) - len(missing))
+    if missing:
+        computed = np.asarray(compute(cnvs.iloc[missing]))
+        _result_cache.set_many(kind, v, [keys[i] for i in missing], computed)
+        for j, i in enumerate(missing):
+            values[i] = computed[j]
+
+    res = np.array([np.asarray(value, dtype=DTYPES[kind]).reshape(-1) for value in values])
+    # probabilities are scalars per CNV
+    return res[:, 0] if kind == "proba" else res
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Evaluation of xgboost tree ensembles without xgboost
+
+Trees of an xgboost JSON model are flattened into node arrays and evaluated by a compiled kernel. As in the xgboost
+CPU predictor, features are compared as float32 (left if feature < threshold, missing values follow the default
+direction), leaf values are accumulated in float32 starting from the base margin, and the logistic transform is
+applied in float32.
+
+Approximate contributions of features (Saabas) are computed along the decision path of each tree: a split feature
+is credited with the change of the expected value between a node and its child, where expected values of nodes are
+averages of their leaves weighted by hessian covers, as in xgboost's approx_contribs.
+"""
+import json
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numba as nb
+import numpy as np
+
+from isv.config import settings
+from isv.scripts import profiling
+
+TreeEnsemble = namedtuple("TreeEnsemble", ["roots", "left", "right", "feature", "threshold", "default_left",
+                                           "base_margin", "mean_value"])
+TreeEnsemble.__doc__ = """Flat node arrays of a tree ensemble
+
+Nodes of all trees are concatenated, child indices point into the concatenated arrays. Leaves have left == -1 \
+and their value in threshold.
+
+:param roots: int64 array with the root node of each tree
+:param left: int64 array of left children
+:param right: int64 array of right children
+:param feature: int64 array of split features
+:param threshold: float32 array of split conditions, or leaf values
+:param default_left: bool array of directions of missing values
+:param base_margin: float32 array with a single item, the margin of an empty ensemble
+:param mean_value: float64 array of expected values of nodes (cover weighted averages of their leaves)
+"""
+
+# objectives with a logistic output transform
+LOGISTIC_OBJECTIVES = ["binary:logistic", "reg:logistic"]
+
+
+def from_json(model_path):
+    """Flatten an xgboost JSON model
+
+    :param model_path: path to a model saved with Booster.save_model as JSON
+
+    :return: TreeEnsemble
+    """
+    with open(model_path, 'r') as f:
+        learner = json.load(f)["learner"]
+
+    booster = learner["gradient_booster"]
+    if booster["name"] != "gbtree":
+        raise ValueError(f"Unsupported booster {booster['name']}, only gbtree models can be evaluated")
+    if learner["objective"]["name"] not in LOGISTIC_OBJECTIVES:
+        raise ValueError(f"Unsupported objective {learner['objective']['name']}")
+    if int(learner["learner_model_param"]["num_class"]) > 1:
+        raise ValueError("Multiclass models are not supported")
+
+    roots, left, right, feature, threshold, default_left, mean_value = [], [], [], [], [], [], []
+    offset = 0
+    for tree in booster["model"]["trees"]:
+        n = len(tree["left_children"])
+        children = [np.array(tree[i], dtype=np.int64) for i in ["left_children", "right_children"]]
+        # child indices point into the concatenated arrays, leaves keep -1
+        left.append(np.where(children[0] == -1, -1, children[0] + offset))
+        right.append(np.where(children[1] == -1, -1, children[1] + offset))
+        feature.append(np.array(tree["split_indices"], dtype=np.int64))
+        threshold.append(np.array(tree["split_conditions"], dtype=np.float32))
+        default_left.append(np.array(tree["default_left"], dtype=np.bool_))
+        mean_value.append(node_mean_values(children[0], children[1], threshold[-1],
+                                           np.array(tree["sum_hessian"], dtype=np.float64)))
+        roots.append(offset)
+        offset += n
+
+    # base score is a probability
+    base_score = np.float32(learner["learner_model_param"]["base_score"])
+    base_margin = -np.log(np.float32(1) / base_score - np.float32(1))
+
+    return TreeEnsemble(np.array(roots, dtype=np.int64),
+                        np.concatenate(left),
+                        np.concatenate(right),
+                        np.concatenate(feature),
+                        np.concatenate(threshold),
+                        np.concatenate(default_left),
+                        np.array([base_margin], dtype=np.float32),
+                        np.concatenate(mean_value))
+
+
+def node_mean_values(left, right, value, cover):
+    """Expected values of nodes of a single tree
+
+    :param left: left children (-1 for leaves)
+    :param right: right children
+    :param value: leaf values
+    :param cover: hessian covers of nodes
+
+    :return: float64 array
+    """
+    mean = value.astype(np.float64)
+    # children have larger indices than their parents
+    for node in range(len(left) - 1, -1, -1):
+        if left[node] != -1:
+            l, r = left[node], right[node]
+            mean[node] = (mean[l] * cover[l] + mean[r] * cover[r]) / cover[node]
+    return mean
+
+
+def load_tree_ensemble(cnv_type):
+    """Return the flattened ISV model for given cnv type. Model is flattened once and cached in memory
+
+    :param cnv_type: type of the cnv == ["loss", "gain"]
+
+    :return: TreeEnsemble
+    """
+    return _load_tree_ensemble(os.path.join(settings.model_dir, f'ISV_{cnv_type}.json'))
+
+
+@lru_cache(maxsize=None)
+def _load_tree_ensemble(model_path):
+    with profiling.stage("load_model"):
+        return from_json(model_path)
+
+
+def clear_tree_ensembles():
+    """Remove cached flattened models"""
+    _load_tree_ensemble.cache_clear()
+
+
+@nb.jit(nopython=True, cache=True)
+def predict_margin_row(ensemble, x):
+    """Margin of a single feature vector
+
+    :param ensemble: TreeEnsemble
+    :param x: float32 feature vector
+
+    :return: float32 margin
+    """
+    margin = ensemble.base_margin[0]
+    # trees in model order, so that float32 sums match xgboost
+    for root in ensemble.roots:
+        node = root
+        while ensemble.left[node] != -1:
+            value = x[ensemble.feature[node]]
+            if np.isnan(value):
+                go_left = ensemble.default_left[node]
+            else:
+                go_left = value < ensemble.threshold[node]
+            node = ensemble.left[node] if go_left else ensemble.right[node]
+        margin += ensemble.threshold[node]
+    return margin
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def predict_proba(ensemble, X):
+    """Predicted probabilities of a feature matrix
+
+    :param ensemble: TreeEnsemble
+    :param X: float32 feature matrix
+
+    :return: float32 array of probabilities
+    """
+    res = np.empty(X.shape[0], dtype=np.float32)
+    one = np.float32(1)
+    for i in nb.prange(X.shape[0]):
+        res[i] = one / (one + np.exp(-predict_margin_row(ensemble, X[i])))
+    return res
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def predict_contributions(ensemble, X):
+    """Approximate (Saabas) contributions of features to margins
+
+    :param ensemble: TreeEnsemble
+    :param X: float32 feature matrix
+
+    :return: float64 array of shape (n_cnvs, n_features + 1), the last column is the expected margin (bias). \
+    Rows sum to margins
+    """
+    res = np.zeros((X.shape[0], X.shape[1] + 1), dtype=np.float64)
+    bias = np.float64(ensemble.base_margin[0])
+    for root in ensemble.roots:
+        bias += ensemble.mean_value[root]
+
+    for i in nb.prange(X.shape[0]):
+        x = X[i]
+        res[i, -1] = bias
+        for root in ensemble.roots:
+            node = root
+            while ensemble.left[node] != -1:
+                value = x[ensemble.feature[node]]
+                if np.isnan(value):
+                    go_left = ensemble.default_left[node]
+                else:
+                    go_left = value < ensemble.threshold[node]
+                child = ensemble.left[node] if go_left else ensemble.right[node]
+                res[i, ensemble.feature[node]] += ensemble.mean_value[child] - ensemble.mean_value[node]
+                node = child
+    return res
+
+
+def contributions_to_proba(contributions):
+    """Transform contributions to margins (log odds) to contributions to probabilities
+
+    Contributions of each CNV are scaled by the slope of the logistic function between the expected margin and \
+    the margin of the CNV, so that they keep their signs and ratios and sum to the difference between the predicted \
+    probability and the probability of the expected margin
+
+    :param contributions: array of shape (n_cnvs, n_features + 1) with expected margins in the last column
+
+    :return: tuple (contributions to probabilities of shape (n_cnvs, n_features), base probabilities)
+    """
+    contributions = np.asarray(contributions, dtype=np.float64)
+    values, bias = contributions[:, :-1], contributions[:, -1]
+    delta = values.sum(axis=1)
+
+    base = 1 / (1 + np.exp(-bias))
+    proba = 1 / (1 + np.exp(-(bias + delta)))
+    # derivative at the expected margin where the margin does not change
+    small = np.abs(delta) < 1e-12
+    slope = np.where(small, base * (1 - base), (proba - base) / np.where(small, 1, delta))
+
+    return values * slope[:, None], base
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sensitivity of ISV predictions to uncertain CNV breakpoints
+
+For start <= end, annotation counts are W(element_start <= end) - W(element_end < start) (see interval_index), so
+the end term only changes when the end passes an element start, and the start term only changes when the start
+passes an element end. Each CNV therefore has a few distinct end states and start states within its uncertainty
+ranges, which are enumerated from the sorted databases, and every feasible pair of them is one feature vector.
+Pairs giving the same input of the model of the cnv type are merged, and distinct vectors of all CNVs are then
+scored in batches.
+"""
+import numba as nb
+import numpy as np
+import pandas as pd
+
+from isv.annotate import load_databases
+from isv.config import settings
+from isv.predict import predict, predict_with_same_cnv_type, classify
+from isv.scripts import profiling
+from isv.scripts.constants import LOSS_ATTRIBUTES, GAIN_ATTRIBUTES
+
+
+@nb.jit(nopython=True, cache=True)
+def starts_between(index, chrom: int, lo: int, hi: int):
+    """Starts of elements with lo < element_start <= hi"""
+    first, last = index.offsets[chrom], index.offsets[chrom + 1]
+    starts = index.starts[first:last]
+    return starts[np.searchsorted(starts, lo, side="right"):np.searchsorted(starts, hi, side="right")]
+
+
+@nb.jit(nopython=True, cache=True)
+def ends_between(index, chrom: int, lo: int, hi: int):
+    """Ends of elements with lo <= element_end < hi"""
+    first, last = index.offsets[chrom], index.offsets[chrom + 1]
+    ends = index.ends[first:last]
+    return ends[np.searchsorted(ends, lo, side="left"):np.searchsorted(ends, hi, side="left")]
+
+
+@nb.jit(nopython=True, cache=True)
+def end_positions(chrom, lo, hi, use_hi_genes, gencode_genes, regulatory, hi_genes, hits_regions):
+    """Ends in [lo, hi] at which the set of overlapped elements changes: lo and starts of elements in (lo, hi]
+
+    :return: sorted array of distinct positions, each representing the ends up to the next position
+    """
+    parts = [starts_between(gencode_genes, chrom, lo, hi), starts_between(regulatory, chrom, lo, hi),
+             starts_between(hits_regions, chrom, lo, hi)]
+    if use_hi_genes:
+        parts.append(starts_between(hi_genes, chrom, lo, hi))
+
+    n = 1
+    for p in parts:
+        n += p.shape[0]
+    positions = np.empty(n, dtype=np.int64)
+    positions[0] = lo
+    i = 1
+    for p in parts:
+        positions[i:(i + p.shape[0])] = p
+        i += p.shape[0]
+    return np.unique(positions)
+
+
+@nb.jit(nopython=True, cache=True)
+def start_positions(chrom, lo, hi, use_hi_genes, gencode_genes, regulatory, hi_genes, hits_regions):
+    """Starts in [lo, hi] at which the set of overlapped elements changes: lo and positions following ends of \
+    elements in [lo, hi)
+
+    :return: sorted array of distinct positions, each representing the starts up to the next position
+    """
+    parts = [ends_between(gencode_genes, chrom, lo, hi), ends_between(regulatory, chrom, lo, hi),
+             ends_between(hits_regions, chrom, lo, hi)]
+    if use_hi_genes:
+        parts.append(ends_between(hi_genes, chrom, lo, hi))
+
+    n = 1
+    for p in parts:
+        n += p.shape[0]
+    positions = np.empty(n, dtype=np.int64)
+    positions[0] = lo
+    i = 1
+    for p in parts:
+        positions[i:(i + p.shape[0])] = p + 1
+        i += p.shape[0]
+    return np.unique(positions)
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def count_states(chroms, start_lo, start_hi, end_lo, end_hi, use_hi_genes,
+                 gencode_genes, regulatory, hi_genes, hits_regions):
+    """Numbers of distinct start and end states of CNVs
+
+    :return: tuple of int64 arrays (numbers of start states, numbers of end states)
+    """
+    n_start = np.empty(chroms.shape[0], dtype=np.int64)
+    n_end = np.empty(chroms.shape[0], dtype=np.int64)
+    for i in nb.prange(chroms.shape[0]):
+        n_start[i] = start_positions(chroms[i], start_lo[i], start_hi[i], use_hi_genes[i],
+                                     gencode_genes, regulatory, hi_genes, hits_regions).shape[0]
+        n_end[i] = end_positions(chroms[i], end_lo[i], end_hi[i], use_hi_genes[i],
+                                 gencode_genes, regulatory, hi_genes, hits_regions).shape[0]
+    return n_start, n_end
+
+
+@nb.jit(nopython=True, parallel=True, cache=True)
+def fill_states(chroms, start_lo, start_hi, end_lo, end_hi, use_hi_genes, start_offsets, end_offsets,
+                gencode_genes, regulatory, hi_genes, hits_regions):
+    """Distinct start and end states of CNVs
+
+    Counts of a CNV in start state j and end state i are end_counts[i] - start_counts[j], if the state pair is
+    feasible (start position <= last end of the end state)
+
+    :return: tuple (first starts of start states, start_counts, last ends of end states, end_counts), states of \
+    CNV i at start_offsets[i]:start_offsets[i + 1] and end_offsets[i]:end_offsets[i + 1]
+    """
+    n_attributes = 0
+    for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+        n_attributes += index.start_cum.shape[1]
+
+    starts = np.empty(start_offsets[-1], dtype=np.int64)
+    start_counts = np.empty((start_offsets[-1], n_attributes), dtype=np.int32)
+    last_ends = np.empty(end_offsets[-1], dtype=np.int64)
+    end_counts = np.empty((end_offsets[-1], n_attributes), dtype=np.int32)
+
+    for i in nb.prange(chroms.shape[0]):
+        chrom = chroms[i]
+        s = start_positions(chrom, start_lo[i], start_hi[i], use_hi_genes[i],
+                            gencode_genes, regulatory, hi_genes, hits_regions)
+        e = end_positions(chrom, end_lo[i], end_hi[i], use_hi_genes[i],
+                          gencode_genes, regulatory, hi_genes, hits_regions)
+        starts[start_offsets[i]:start_offsets[i + 1]] = s
+        last_ends[end_offsets[i]:(end_offsets[i + 1] - 1)] = e[1:] - 1
+        last_ends[end_offsets[i + 1] - 1] = end_hi[i]
+
+        # order of settings.attributes
+        j = 0
+        for index in (gencode_genes, hi_genes, hits_regions, regulatory):
+            k = index.start_cum.shape[1]
+            lo, hi = index.offsets[chrom], index.offsets[chrom + 1]
+            for m in range(s.shape[0]):
+                b = lo + np.searchsorted(index.ends[lo:hi], s[m], side="left")
+                start_counts[start_offsets[i] + m, j:(j + k)] = index.end_cum[b]
+            for m in range(e.shape[0]):
+                a = lo + np.searchsorted(index.starts[lo:hi], e[m], side="right")
+                end_counts[end_offsets[i] + m, j:(j + k)] = index.start_cum[a]
+            j += k
+
+    return starts, start_counts, last_ends, end_counts
+
+
+def uncertainty_bounds(positions, uncertainty):
+    """Lowest and highest positions within an uncertainty range
+
+    :param positions: array of positions
+    :param uncertainty: int (position +- uncertainty), tuple of offsets (lower, upper), or array of shape (n, 2) \
+    of per CNV offsets
+
+    :return: tuple of int64 arrays (lowest, highest)
+    """
+    offsets = np.asarray(uncertainty, dtype=np.int64)
+    if offsets.ndim == 0:
+        offsets = np.array([-offsets, offsets])
+    offsets = np.broadcast_to(offsets, (len(positions), 2))
+    assert (offsets[:, 0] <= offsets[:, 1]).all(), "lower offsets have to be lower or equal to upper offsets"
+    return positions + offsets[:, 0], positions + offsets[:, 1]
+
+
+def state_pairs(n_start, n_end, start_offsets, end_offsets, starts, last_ends):
+    """Feasible pairs of start and end states of CNVs
+
+    :return: tuple of int64 arrays (cnv positions, start states, end states), ordered by CNV
+    """
+    n_pairs = n_start * n_end
+    cnv = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    k = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    end_state = end_offsets[cnv] + k // n_start[cnv]
+    start_state = start_offsets[cnv] + k % n_start[cnv]
+
+    feasible = starts[start_state] <= last_ends[end_state]
+    return cnv[feasible], start_state[feasible], end_state[feasible]
+
+
+def breakpoint_sensitivity(annotated: pd.DataFrame, start_uncertainty, end_uncertainty, threshold: float = 0.95,
+                           backend: str = None, max_vectors: int = 1000000):
+    """Range of ISV predictions of CNVs whose breakpoints are uncertain
+
+    Every distinct input of the model of the cnv type reachable by moving the start within start_uncertainty \
+    and the end within end_uncertainty (keeping start <= end) is scored once. Since only element boundaries change \
+    counts, vectors are enumerated from the sorted databases instead of annotating every perturbed position. The \
+    median is taken over these distinct inputs, not over positions, so it is not weighted by how many \
+    breakpoint positions lead to each input. CNVs whose ranges do not allow start <= end (start > end with zero \
+    uncertainty) are scored as annotated, like by predict. Otherwise such ranges raise a ValueError
+
+    :param annotated: annotated CNVs, as returned by isv.annotate
+    :param start_uncertainty: int (start +- uncertainty), tuple of offsets (lower, upper), or array of shape (n, 2) \
+    of per CNV offsets
+    :param end_uncertainty: same for the end
+    :param threshold: probability threshold for classifying CNVs into three classes: Pathogenic (>= threshold), \
+    Uncertain significance ((1-threshold, threshold)) or Benign (<= 1 - threshold)
+    :param backend: prediction backend, either "xgboost" or "numba". See isv.predict
+    :param max_vectors: maximum number of state pairs enumerated at once
+
+    :return: pandas dataframe with the lowest, median and highest predicted probability (ISV_min, ISV_median, \
+    ISV_max) over distinct model inputs, the number of distinct model inputs (n_vectors), classes of the lowest \
+    and highest probability and whether the class is stable within the uncertainty ranges
+    """
+    annotated = annotated.reset_index(drop=True)
+    n = len(annotated)
+    chroms = annotated.chrom.cat.codes.values.astype(np.int64) + 1
+    is_dup = (annotated.cnv_type == "DUP").values
+    start_lo, start_hi = uncertainty_bounds(annotated.start.values.astype(np.int64), start_uncertainty)
+    end_lo, end_hi = uncertainty_bounds(annotated.end.values.astype(np.int64), end_uncertainty)
+    start_lo = np.maximum(start_lo, 1)
+    # CNVs with start > end and fixed breakpoints are scored as annotated, like by predict. Their bounds are
+    # replaced by a valid range, whose results are overwritten
+    inverted = start_lo > end_hi
+    fixed = (start_lo == start_hi) & (end_lo == end_hi)
+    if (inverted & ~fixed).any():
+        raise ValueError("uncertainty ranges of CNVs with start > end have to allow start <= end, or be 0. "
+                         f"CNVs at positions {np.where(inverted & ~fixed)[0].tolist()} do not")
+    start_lo[inverted] = start_hi[inverted] = end_lo[inverted] = end_hi[inverted] = 1
+    # only starts up to the last end, and ends from the first start can be paired
+    start_hi = np.minimum(start_hi, end_hi)
+    end_lo = np.maximum(end_lo, start_lo)
+
+    databases = load_databases()
+    # haploinsufficient genes are not attributes of duplications, their boundaries do not change predictions
+    use_hi_genes = ~is_dup
+    with profiling.stage("breakpoint_states"):
+        n_start, n_end = count_states(chroms, start_lo, start_hi, end_lo, end_hi, use_hi_genes, *databases)
+        start_offsets = np.concatenate([[0], np.cumsum(n_start)])
+        end_offsets = np.concatenate([[0], np.cumsum(n_end)])
+        starts, start_counts, last_ends, end_counts = fill_states(
+            chroms, start_lo, start_hi, end_lo, end_hi, use_hi_genes, start_offsets, end_offsets, *databases)
+
+    res = pd.DataFrame({"ISV_min": np.zeros(n), "ISV_median": np.zeros(n), "ISV_max": np.zeros(n),
+                        "n_vectors": np.zeros(n, dtype=np.int64)})
+
+    # chunks of whole CNVs with at most max_vectors state pairs, or a single CNV
+    cum_pairs = np.cumsum(n_start * n_end)
+    first = 0
+    while first < n:
+        done = cum_pairs[first - 1] if first > 0 else 0
+        last = max(np.searchsorted(cum_pairs, done + max_vectors, side="right"), first + 1)
+        ind = np.arange(first, last)
+        cnv, start_state, end_state = state_pairs(n_start[ind], n_end[ind], start_offsets[ind], end_offsets[ind],
+                                                  starts, last_ends)
+        counts = end_counts[end_state] - start_counts[start_state]
+
+        # different pairs can give the same model input (e.g. boundaries of attributes the model does not use),
+        # only distinct vectors of each cnv are scored
+        vector_cnv, proba = [], []
+        for dup, cnv_type, attributes in [(False, "loss", LOSS_ATTRIBUTES), (True, "gain", GAIN_ATTRIBUTES)]:
+            rows = np.where(is_dup[ind[cnv]] == dup)[0]
+            if len(rows) == 0:
+                continue
+            columns = [settings.attributes.index(a) for a in attributes]
+            vectors = np.unique(np.column_stack([cnv[rows], counts[rows][:, columns]]), axis=0)
+            vector_cnv.append(vectors[:, 0])
+            proba.append(predict_with_same_cnv_type(pd.DataFrame(vectors[:, 1:], columns=attributes, copy=False),
+                                                    cnv_type, backend))
+        cnv, proba = np.concatenate(vector_cnv), np.concatenate(proba)
+        profiling.count("vectors_scored", len(cnv))
+
+        # probabilities sorted within cnvs, every cnv has at least one feasible pair
+        order = np.lexsort((proba, cnv))
+        proba, cnv = proba[order], cnv[order]
+        group_starts = np.searchsorted(cnv, np.arange(len(ind)))
+        n_vectors = np.diff(np.append(group_starts, len(cnv)))
+        res.loc[ind, "ISV_min"] = proba[group_starts]
+        res.loc[ind, "ISV_max"] = proba[group_starts + n_vectors - 1]
+        res.loc[ind, "ISV_median"] = (proba[group_starts + (n_vectors - 1) // 2] +
+                                      proba[group_starts + n_vectors // 2]) / 2
+        res.loc[ind, "n_vectors"] = n_vectors
+        first = last
+
+    if inverted.any():
+        yh = predict(annotated.loc[inverted], backend=backend)
+        for column in ["ISV_min", "ISV_median", "ISV_max"]:
+            res.loc[inverted, column] = yh
+        res.loc[inverted, "n_vectors"] = 1
+
+    res["class_min"] = classify(res.ISV_min.values, threshold)
+    res["class_max"] = classify(res.ISV_max.values, threshold)
+    res["stable"] = res.class_min == res.class_max
+
+    return res
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local HTTP prediction service
+
+Databases, models, scalers and explainers are loaded once, when the server starts. Concurrent requests to the
+same endpoint arriving within a short time window are coalesced into a single batched annotate/predict call.
+
+Run with ``python -m isv.server --port 8000``
+
+Endpoints:
+
+- POST /predict, /annotate and /shap with a JSON body ``{"cnvs": [[chromosome, start, end, cnv_type], ...]}``. \
+  /predict also accepts optional "proba" (default true) and "threshold" (default 0.95) keys
+- GET /metrics with request, CNV and batch counters, latency percentiles and throughput per endpoint
+"""
+import asyncio
+import json
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from isv import ISV, annotate, warmup
+from isv.config import settings
+from isv.predict import classify
+from isv.scripts.helpers import check_cnvs_obj
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+
+
+def predict_batch(cnvs):
+    """Predict probabilities of a batch of CNVs"""
+    return ISV(cnvs).predict(proba=True)
+
+
+def shap_batch(cnvs):
+    """Calculate SHAP values of a batch of CNVs"""
+    return ISV(cnvs).shap()
+
+
+class Metrics:
+    """Latency and throughput counters of the server
+
+    :param n_latencies: number of most recent request latencies kept for percentiles
+    """
+
+    def __init__(self, n_latencies: int = 1000):
+        self.started = time.time()
+        self.n_latencies = n_latencies
+        self.endpoints = {}
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {"requests": 0, "errors": 0, "cnvs": 0, "batches": 0, "batch_seconds": 0.0,
+                                        "latencies": deque(maxlen=self.n_latencies)}
+        return self.endpoints[endpoint]
+
+    def record_request(self, endpoint, n_cnvs, latency, error=False):
+        m = self._endpoint(endpoint)
+        m["requests"] += 1
+        m["errors"] += error
+        m["cnvs"] += n_cnvs
+        m["latencies"].append(latency)
+
+    def record_batch(self, endpoint, elapsed):
+        m = self._endpoint(endpoint)
+        m["batches"] += 1
+        m["batch_seconds"] += elapsed
+
+    def to_dict(self):
+        uptime = time.time() - self.started
+        res = {"uptime_seconds": uptime, "endpoints": {}}
+        for endpoint, m in self.endpoints.items():
+            latencies = np.array(m["latencies"]) * 1000
+            res["endpoints"][endpoint] = {
+                "requests": m["requests"],
+                "errors": m["errors"],
+                "cnvs": m["cnvs"],
+                "batches": m["batches"],
+                "mean_batch_requests": m["requests"] / m["batches"] if m["batches"] else 0,
+                "cnvs_per_second": m["cnvs"] / uptime,
+                "cnvs_per_batch_second": m["cnvs"] / m["batch_seconds"] if m["batch_seconds"] else 0,
+                "latency_ms": {f"p{q}": float(np.percentile(latencies, q)) if len(latencies) else None
+                               for q in [50, 95, 99, 100]},
+            }
+        return res
+
+
+class Batcher:
+    """Coalesce requests to a single endpoint into batches
+
+    :param fun: function computing results for a dataframe of CNVs, returning a dataframe with one row per CNV
+    :param executor: executor running the computation, so that the event loop keeps accepting requests
+    :param window: seconds to wait for more requests after the first request of a batch
+    :param max_batch: maximum number of CNVs in a batch. A full batch is computed right away
+    :param on_batch: callback receiving the elapsed time of each batch
+    """
+
+    def __init__(self, fun, executor, window: float = 0.01, max_batch: int = 10000, on_batch=None):
+        self.fun = fun
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.on_batch = on_batch
+        self.pending = []
+        self.pending_cnvs = 0
+        self.flush_handle = None
+
+    async def submit(self, cnvs):
+        """Add CNVs to the next batch and wait for their results
+
+        :param cnvs: dataframe of CNVs
+
+        :return: dataframe of results for these CNVs
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((cnvs, future))
+        self.pending_cnvs += len(cnvs)
+
+        if self.pending_cnvs >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        """Compute the pending batch"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch, self.pending, self.pending_cnvs = self.pending, [], 0
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        cnvs = pd.concat([b[0] for b in batch], ignore_index=True)
+
+        start = time.time()
+        try:
+            result = await loop.run_in_executor(self.executor, self.fun, cnvs)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            if self.on_batch is not None:
+                self.on_batch(time.time() - start)
+
+        offset = 0
+        for b, future in batch:
+            if not future.done():
+                future.set_result(result.iloc[offset:(offset + len(b))].reset_index(drop=True))
+            offset += len(b)
+
+
+class ISVServer:
+    """HTTP server with preloaded ISV state and request micro-batching
+
+    :param window: seconds to wait for more requests before a batch is computed
+    :param max_batch: maximum number of CNVs in a batch
+    :param shap: whether SHAP explainers should be created on start
+    """
+
+    def __init__(self, window: float = 0.01, max_batch: int = 10000, shap: bool = True):
+        # load state and launch the numba thread pool in the calling thread. A TBB thread pool first launched
+        # from an executor thread can hang the interpreter on exit
+        warmup(shap)
+
+        self.metrics = Metrics()
+        # one computation at a time, batching provides the throughput
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {
+            endpoint: Batcher(fun, self.executor, window, max_batch,
+                              on_batch=lambda elapsed, endpoint=endpoint: self.metrics.record_batch(endpoint, elapsed))
+            for endpoint, fun in [("/predict", predict_batch), ("/annotate", annotate), ("/shap", shap_batch)]
+        }
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        """Start listening
+
+        :return: asyncio server
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        """Handle a single HTTP request"""
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            method, path = request_line.split(" ")[:2]
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self.route(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": f"Malformed request: {e}"}
+
+        data = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                     f"Content-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method, path, body):
+        """Route a request to an endpoint
+
+        :return: tuple (status, json payload)
+        """
+        if path == "/metrics":
+            if method != "GET":
+                return 405, {"error": "Use GET"}
+            return 200, self.metrics.to_dict()
+
+        if path not in self.batchers:
+            return 404, {"error": f"Unknown endpoint {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+
+        start = time.time()
+        try:
+            request = json.loads(body)
+            cnvs = parse_cnvs(request["cnvs"])
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            self.metrics.record_request(path, 0, time.time() - start, error=True)
+            return 400, {"error": str(e)}
+
+        try:
+            result = await self.batchers[path].submit(cnvs)
+        except Exception as e:
+            self.metrics.record_request(path, len(cnvs), time.time() - start, error=True)
+            return 500, {"error": str(e)}
+
+        if path == "/predict" and not request.get("proba", True):
+            result["ISV"] = classify(result.ISV.values, request.get("threshold", 0.95))
+
+        self.metrics.record_request(path, len(cnvs), time.time() - start)
+        # python objects keep full float precision, missing values become null
+        return 200, {"results": result.astype(object).where(result.notna(), None).to_dict(orient="records")}
+
+
+def parse_cnvs(cnvs):
+    """Validate CNVs of a single request, so that an invalid request can not fail a whole batch
+
+    :param cnvs: list of [chromosome, start, end, cnv_type]
+
+    :return: pandas dataframe
+    """
+    cnvs = check_cnvs_obj(pd.DataFrame(cnvs))
+    cnvs.columns = ["chromosome", "start", "end", "cnv_type"]
+    cnvs["chromosome"] = [str(i) if str(i).startswith("chr") else f"chr{i}" for i in cnvs.chromosome]
+
+    invalid = [i for i in cnvs.chromosome if i not in settings.chromosome_dict]
+    if invalid:
+        raise ValueError(f"Unknown chromosome {invalid[0]}")
+
+    cnvs["start"] = cnvs.start.astype(np.int64)
+    cnvs["end"] = cnvs.end.astype(np.int64)
+    return cnvs
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, window: float = 0.01, max_batch: int = 10000,
+          shap: bool = True):
+    """Run the server until interrupted
+
+    :param host: host to bind
+    :param port: port to bind
+    :param window: seconds to wait for more requests before a batch is computed
+    :param max_batch: maximum number of CNVs in a batch
+    :param shap: whether SHAP explainers should be created on start
+    """
+    isv_server = ISVServer(window, max_batch, shap)
+
+    async def main():
+        server = await isv_server.start(host, port)
+        print(f"Serving ISV on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("ISV prediction server")
+
+    parser.add_argument("--host", required=False, type=str, default="127.0.0.1", help="host to bind")
+    parser.add_argument("--port", required=False, type=int, default=8000, help="port to bind")
+    parser.add_argument("--window", required=False, type=float, default=0.01,
+                        help="seconds to wait for more requests before a batch is computed")
+    parser.add_argument("--max-batch", required=False, type=int, default=10000,
+                        help="maximum number of CNVs in a batch")
+    parser.add_argument("--no-shap", required=False, action="store_true",
+                        help="Do not create SHAP explainers on start")
+
+    args = parser.parse_args()
+    serve(args.host, args.port, args.window, args.max_batch, not args.no_shap)
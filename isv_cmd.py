@@ -1,27 +1,223 @@
+import sys
+from contextlib import nullcontext
 from argparse import ArgumentParser
+import numpy as np
 import pandas as pd
-from isv import isv
+from isv import isv, ISV, preload, warmup, enable_result_cache, profile, settings
+from isv.scripts.constants import HUMAN_READABLE, LOSS_ATTRIBUTES, GAIN_ATTRIBUTES
+
+# SHAP columns of CNVs with both cnv types, so that all chunks share the same columns
+SHAP_COLUMNS = ['SHAP_' + HUMAN_READABLE[i].replace(' ', '_')
+                for i in LOSS_ATTRIBUTES + [i for i in GAIN_ATTRIBUTES if i not in LOSS_ATTRIBUTES]]
+
+
+# Arrow IPC (Feather V2) file extensions
+ARROW_EXTENSIONS = ('.feather', '.arrow', '.ipc')
+
+# categories of ISV classes in typed output
+CLASSES = ["Benign", "Uncertain significance", "Pathogenic"]
+
+
+def read_input(filepath, chunksize=None):
+    """Read input CNVs
+
+    Parquet and Arrow IPC inputs are returned as pyarrow tables. Arrow IPC files are memory mapped
+
+    :param filepath: path to a '.tsv', '.bed', '.csv', '.parquet', '.feather', '.arrow' or '.ipc' file
+    :param chunksize: if set, an iterator of dataframes (or tables) with chunksize rows is returned
+
+    :return: pandas dataframe, pyarrow table or iterator of them
+    """
+    if filepath.endswith('.tsv') or filepath.endswith('.bed'):
+        return pd.read_csv(filepath, sep='\t', chunksize=chunksize)
+    elif filepath.endswith('.csv'):
+        return pd.read_csv(filepath, chunksize=chunksize)
+    elif filepath.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if chunksize is None:
+            return pq.read_table(filepath)
+        return (pa.Table.from_batches([b]) for b in pq.ParquetFile(filepath).iter_batches(batch_size=chunksize))
+    elif filepath.endswith(ARROW_EXTENSIONS):
+        import pyarrow as pa
+
+        table = pa.ipc.open_file(pa.memory_map(filepath)).read_all()
+        if chunksize is None:
+            return table
+        return (table.slice(i, chunksize) for i in range(0, table.num_rows, chunksize))
+    else:
+        exit("Unknown File extension. Use '.tsv', '.bed', '.csv', '.parquet', '.feather', '.arrow' or '.ipc'")
+
+
+class ResultWriter:
+    """Write results to a tsv, parquet or arrow IPC file, chunk by chunk
+
+    Columnar outputs keep column types: chromosome, cnv type and ISV classes are dictionary encoded, probabilities \
+    and SHAP values are float64
+
+    :param filepath: path to the output file. Parquet is used for '.parquet', Arrow IPC for '.feather', '.arrow' \
+    and '.ipc', and tsv otherwise
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.writer = None
+        self.schema = None
+
+    def write(self, result):
+        """Append results
+
+        :param result: dataframe of results. All chunks have to share the same columns
+        """
+        if self.filepath.endswith('.parquet') or self.filepath.endswith(ARROW_EXTENSIONS):
+            self._write_arrow(result)
+        elif self.writer is None:
+            self.writer = open(self.filepath, 'w')
+            result.to_csv(self.writer, sep='\t', index=False)
+        else:
+            result.to_csv(self.writer, sep='\t', index=False, header=False)
+        if not self.filepath.endswith('.parquet') and not self.filepath.endswith(ARROW_EXTENSIONS):
+            # partial results are visible during long streaming runs
+            self.writer.flush()
+
+    def _write_arrow(self, result):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if result.ISV.dtype == object:
+            result = result.assign(ISV=pd.Categorical(result.ISV, categories=CLASSES))
+
+        if self.writer is None:
+            table = pa.Table.from_pandas(result, preserve_index=False)
+            self.schema = table.schema
+            if self.filepath.endswith('.parquet'):
+                self.writer = pq.ParquetWriter(self.filepath, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filepath, self.schema)
+        else:
+            table = pa.Table.from_pandas(result, schema=self.schema, preserve_index=False)
+
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream(input_path, output_path, chunksize, proba=False, shap=False, shap_proba_range=None):
+    """Predict CNVs chunk by chunk and append results to the output file
+
+    :param input_path: path to input CNVs
+    :param output_path: path to the output file
+    :param chunksize: number of CNVs processed at once
+    :param proba: whether probabilities should be calculated
+    :param shap: whether shap values should be calculated
+    :param shap_proba_range: tuple (low, high), shap values are calculated only for CNVs with \
+    low < probability < high
+    """
+    preload(shap=shap)
+
+    with ResultWriter(output_path) as writer:
+        for bed in read_input(input_path, chunksize=chunksize):
+            if isinstance(bed, pd.DataFrame):
+                bed = bed.reset_index(drop=True)
+            result = isv(cnvs=bed, proba=proba, shap=shap, shap_proba_range=shap_proba_range)
+            if shap:
+                result = result.reindex(columns=list(result.columns[:5]) + SHAP_COLUMNS)
+
+            writer.write(result)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser("Interpretation of Structural Copy Number Variants")
 
-    parser.add_argument("-i", "--input", required=True, help="data to be predicted", type=str)
-    parser.add_argument("-o", "--output", required=False, help="where the output tsv will be saved",
+    parser.add_argument("-i", "--input", required=False, help="data to be predicted", type=str)
+    parser.add_argument("-o", "--output", required=False,
+                        help="where the output will be saved. Parquet for '.parquet', Arrow IPC for '.feather', "
+                             "'.arrow' and '.ipc', tsv otherwise",
                         type=str, default="./isv_predictions.tsv")
     parser.add_argument("-p", "--proba", required=False, action="store_true", help="Return probabilities")
     parser.add_argument("-sv", "--shapvalues", required=False, help="Calculate SHAP Values", action="store_true")
+    parser.add_argument("--shap-proba-range", required=False, type=float, nargs=2, default=None,
+                        metavar=("LOW", "HIGH"),
+                        help="Calculate SHAP Values only for CNVs with LOW < probability < HIGH, "
+                             "e.g. 0.05 0.95 for CNVs of uncertain significance")
+    parser.add_argument("--shap-method", required=False, choices=["exact", "xgboost", "approximate"], default=None,
+                        help="SHAP method. 'xgboost' computes path dependent tree SHAP natively in xgboost, "
+                             "'approximate' attributes predictions along decision paths (Saabas)")
+    parser.add_argument("-c", "--chunksize", required=False, type=int, default=None,
+                        help="Stream the input in chunks of this many CNVs, appending results to the output")
+    parser.add_argument("-w", "--warmup", required=False, action="store_true",
+                        help="Compile annotation kernels and load databases and models first. "
+                             "Without input, only populates the on-disk kernel cache and exits")
+    parser.add_argument("-rc", "--result-cache", required=False, type=str, default=None,
+                        help="SQLite file caching results of previously seen CNVs across runs")
+    parser.add_argument("-b", "--backend", required=False, choices=["xgboost", "numba"], default=None,
+                        help="Prediction backend. 'numba' evaluates the models without xgboost")
+    parser.add_argument("-r", "--report", required=False, type=str, default=None,
+                        help="Write waterfall plots of all CNVs to a combined html file (path ending with '.html') "
+                             "or to a directory with one file per CNV")
+    parser.add_argument("--report-format", required=False, choices=["html", "png"], default="html",
+                        help="Format of per CNV waterfall plots. png requires kaleido")
+    parser.add_argument("--profile", required=False, action="store_true",
+                        help="Print time spent in each stage and counters of processed CNVs to stderr")
 
     args = parser.parse_args()
 
-    if args.input.endswith('.tsv') or args.input.endswith('.bed'):
-        bed = pd.read_csv(args.input, sep='\t')
-    elif args.input.endswith('.csv'):
-        bed = pd.read_csv(args.input)
-    else:
-        exit("Unknown File extension. Use '.tsv', '.bed' or '.csv'")
+    if args.backend is not None:
+        settings.predict_backend = args.backend
+    if args.shap_method is not None:
+        settings.shap_method = args.shap_method
+
+    if args.warmup:
+        warmup(shap=args.shapvalues)
+        if args.input is None:
+            exit(0)
+
+    if args.input is None:
+        parser.error("the following arguments are required: -i/--input")
+    if args.report is not None and args.chunksize is not None:
+        parser.error("-r/--report can not be combined with -c/--chunksize")
 
-    final = isv(cnvs=bed, proba=args.proba, shap=args.shapvalues)
+    if args.result_cache is not None:
+        enable_result_cache(args.result_cache)
 
-    final.to_csv(args.output, sep='\t', index=False)
+    with profile() if args.profile else nullcontext() as p:
+        if args.chunksize is not None:
+            stream(args.input, args.output, args.chunksize, proba=args.proba, shap=args.shapvalues,
+                   shap_proba_range=args.shap_proba_range)
+        else:
+            cnv_isv = ISV(read_input(args.input))
+            final = cnv_isv.predict(proba=args.proba)
+
+            if args.shapvalues or args.report is not None:
+                explained = None
+                if args.shap_proba_range is not None:
+                    low, high = args.shap_proba_range
+                    yh = final.ISV if args.proba else cnv_isv.predict().ISV
+                    explained = np.where((yh > low) & (yh < high))[0]
+
+                # the report explains all CNVs, its SHAP values are reused in the output
+                sv = cnv_isv.shap(cnv_isv.annotated, cnv_indexes=explained if args.report is None else None)
+                if args.report is not None:
+                    cnv_isv.waterfall_report(args.report, fmt=args.report_format, shap_values=sv)
+                if args.shapvalues:
+                    if explained is not None:
+                        sv = sv.loc[explained].reindex(sv.index)
+                    final = pd.concat([final, sv], axis=1)
+
+            with ResultWriter(args.output) as writer:
+                writer.write(final)
     print(f"Results saved to {args.output}")
+    if args.report is not None:
+        print(f"Waterfall plots saved to {args.report}")
+
+    if args.profile:
+        print(p.report(), file=sys.stderr)
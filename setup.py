@@ -29,6 +29,7 @@ setup(
     python_requires='>=3.6, <4',
     install_requires=["numpy>=1.22.0,<2", "xgboost>=1.4.0,<2", "pandas>=1.2.0,<2", "shap>=0.39.0",
                       "sklearn-json>=0.1.0", "numba>=0.53.0", "plotly>5,<6"],
+    extras_require={"arrow": ["pyarrow>=7.0.0"]},
     keywords=['python', 'machine learning', 'copy number variation'],
     license_files="LICENSE.txt",
     classifiers=[  # Optional
@@ -46,3 +46,43 @@ def test_model_retrain():
         val_preds = (val_preds > 0.5) * 1
 
         assert len(val_preds) == len(val_Y)
+
+
+def test_feature_store(tmp_path):
+    from isv import profile
+    from isv.alternative import alternative_arrays, enable_feature_store, disable_feature_store
+
+    train = pd.read_csv('isv/data/train_gain.tsv.gz', sep='\t', compression='gzip').iloc[:500]
+    cnvs = train.loc[:, ["chr", "start_hg38", "end_hg38"]]
+    cnvs["cnv_type"] = "DUP"
+    extra = {'extra': np.random.rand(len(cnvs))}
+
+    expected = alternative_arrays(cnvs.copy(), train.clinsig.values, extra, 'gain')
+    enable_feature_store(str(tmp_path))
+    try:
+        alternative_arrays(cnvs.copy(), train.clinsig.values, extra, 'gain')
+        with profile() as p:
+            res = alternative_arrays(cnvs.copy(), train.clinsig.values, extra, 'gain')
+    finally:
+        disable_feature_store()
+
+    assert p.to_dict()["counters"]["feature_store_hits"] == len(cnvs)
+    assert "annotate" not in p.to_dict()["stages"]
+    assert res[2] == expected[2]
+    assert np.array_equal(res[0], expected[0])
+
+
+def test_parameter_search():
+    from isv.alternative import alternative_arrays, parameter_search
+
+    train = pd.read_csv('isv/data/train_loss.tsv.gz', sep='\t', compression='gzip').iloc[:1000]
+    cnvs = train.loc[:, ["chr", "start_hg38", "end_hg38"]]
+    cnvs["cnv_type"] = "DEL"
+    data = alternative_arrays(cnvs, train.clinsig.values, {'extra': np.random.rand(len(cnvs))}, 'loss')
+
+    space = {'max_depth': [2, 4], 'eta': [0.1, 0.3]}
+    res = parameter_search(data, space=space, n_folds=3, num_boost_round=20, prune_rounds=5, prune_quantile=0.5)
+
+    assert len(res) == 4 and res.pruned.sum() == 2
+    assert res.score.iloc[0] == res[~res.pruned].score.min()
+    assert {'max_depth', 'eta', 'score', 'best_iteration', 'seconds'} <= set(res.columns)
@@ -0,0 +1,62 @@
+import pathlib
+import sys
+
+import numpy as np
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from isv.annotate import annotate_cnv, annotate_cnvs, open_data, save_data
+from isv.scripts.interval_index import build_index, count_overlaps
+
+
+def random_database(rng):
+    cd = {}
+    for c in range(1, 25):
+        n = rng.integers(0, 200)
+        starts = rng.integers(0, 100000, n)
+        cd[c] = np.column_stack([np.full(n, c), starts, starts + rng.integers(0, 5000, n), rng.integers(0, 3, n)])
+        if n == 0:
+            cd[c] = np.array([[-1618] * 4])
+
+    return cd, build_index(cd, lambda arr: np.column_stack([np.ones(len(arr)), arr[:, 3] == 1, arr[:, 3]]))
+
+
+def test_count_overlaps():
+    rng = np.random.default_rng(1618)
+    cd, index = random_database(rng)
+
+    for _ in range(1000):
+        c = rng.integers(1, 25)
+        start, end = rng.integers(0, 105000, 2)
+        arr = cd[c]
+        overlapped = arr[(arr[:, 1] <= end) & (arr[:, 2] >= start)]
+        expected = [len(overlapped), np.sum(overlapped[:, 3] == 1), np.sum(overlapped[:, 3])]
+
+        assert count_overlaps(index, c, start, end).tolist() == expected
+
+
+def test_annotate_cnvs():
+    rng = np.random.default_rng(1618)
+    indexes = [random_database(rng)[1] for _ in range(4)]
+
+    chroms = rng.integers(1, 25, 500)
+    starts = rng.integers(0, 100000, 500)
+    ends = starts + rng.integers(-1000, 20000, 500)
+
+    annotated = annotate_cnvs(chroms, starts, ends, *indexes)
+
+    for i in range(500):
+        assert annotated[i].tolist() == annotate_cnv(chroms[i], starts[i], ends[i], *indexes).tolist()
+
+
+def test_binary_database(tmp_path):
+    rng = np.random.default_rng(1618)
+    cd, index = random_database(rng)
+
+    save_data(str(tmp_path / "database.npy"), cd)
+    mapped = open_data(str(tmp_path / "database.npy"))
+
+    for c in range(1, 25):
+        assert mapped[c].tolist() == [row for row in cd[c].tolist() if row != [-1618] * 4]
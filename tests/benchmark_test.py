@@ -0,0 +1,26 @@
+import sys
+import pathlib
+import json
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from benchmark import synthetic_cnvs, benchmark, CHROMOSOME_LENGTHS
+
+
+def test_synthetic_cnvs():
+    cnvs = synthetic_cnvs(10000)
+
+    assert cnvs.equals(synthetic_cnvs(10000))
+    assert set(cnvs.cnv_type) == {"DEL", "DUP"}
+    assert (cnvs.start >= 1).all() and (cnvs.start <= cnvs.end).all()
+    assert (cnvs.end <= cnvs.chromosome.map(CHROMOSOME_LENGTHS)).all()
+
+
+def test_benchmark():
+    res = benchmark([10, 100], stages=["annotate", "predict"], repeats=2)
+
+    assert [(r["stage"], r["n_cnvs"]) for r in res["results"]] == \
+           [("annotate", 10), ("predict", 10), ("annotate", 100), ("predict", 100)]
+    json.dumps(res)
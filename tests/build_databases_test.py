@@ -0,0 +1,103 @@
+import pathlib
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from isv.annotate import open_data
+from isv.scripts.build_databases import build_databases
+
+
+def write_raw(raw_dir):
+    pd.DataFrame({"chromosome": ["chr2", "chr1", "chrUn", "chr1", "chrX"],
+                  "start": [10, 20, 30, 40, 50], "end": [15, 25, 35, 45, 55],
+                  "gene_name": ["A", "B", "C", "D", "E"],
+                  "type": ["processed_pseudogene", "protein_coding", "lncRNA", "misc_RNA", "miRNA"],
+                  "morbid": [1, None, 0, 0, 1], "disease": [0, 1, 0, None, 0]}) \
+        .to_csv(raw_dir / "gencode_annotsv.tsv.gz", sep='\t', index=False)
+    pd.DataFrame({"chromosome": ["chr3", "chrM"], "start": [1, 2], "end": [5, 6], "type": ["enhancer", None],
+                  "id": ["R1", "R2"]}).to_csv(raw_dir / "regulatory.tsv.gz", sep='\t', index=False)
+    pd.DataFrame({"chromosome": ["chr1"], "start": [1], "end": [5]}) \
+        .to_csv(raw_dir / "hi_genes.tsv.gz", sep='\t', index=False)
+    pd.DataFrame({"chromosome": ["chrY"], "start": [1], "end": [5], "HI": [1], "TS": [0]}) \
+        .to_csv(raw_dir / "hits_regions.tsv.gz", sep='\t', index=False)
+
+
+def test_build_databases(tmp_path):
+    raw_dir, out_dir = tmp_path / "raw", tmp_path / "preprocessed"
+    raw_dir.mkdir()
+    write_raw(raw_dir)
+
+    assert len(build_databases(raw_dir=str(raw_dir), out_dir=str(out_dir), chunksize=2)) == 4
+    assert build_databases(raw_dir=str(raw_dir), out_dir=str(out_dir)) == []
+
+    for f in ["gencode_genes.npy", "gencode_genes.json.gz"]:
+        genes = open_data(str(out_dir / f))
+        # rows in the order of the raw table, recoded types, missing flags are 0
+        assert genes[1].tolist() == [[1, 20, 25, 0, 0, 1], [1, 40, 45, 6, 0, 0]]
+        assert genes[2].tolist() == [[2, 10, 15, 1, 1, 0]]
+        assert genes[23].tolist() == [[23, 50, 55, 3, 1, 0]]
+
+    regulatory = open_data(str(out_dir / "regulatory.npy"))
+    assert sum(len(v) for v in regulatory.values()) == 1
+    assert regulatory[3].tolist() == [[3, 1, 5, 10]]
+
+    pd.DataFrame({"chromosome": ["chr1", "chr2"], "start": [1, 1], "end": [5, 5]}) \
+        .to_csv(raw_dir / "hi_genes.tsv.gz", sep='\t', index=False)
+    assert build_databases(raw_dir=str(raw_dir), out_dir=str(out_dir)) == ["hi_genes"]
+    assert np.load(out_dir / "hi_genes.npy").shape == (2, 3)
+
+
+def test_prebuilt_index(tmp_path):
+    from isv import annotate, settings
+    from isv.annotate import WEIGHTS, load_index
+    from isv.scripts.interval_index import build_index
+
+    raw_dir, out_dir = tmp_path / "raw", tmp_path / "preprocessed"
+    raw_dir.mkdir()
+    write_raw(raw_dir)
+    build_databases(raw_dir=str(raw_dir), out_dir=str(out_dir), save_as_json=False)
+
+    data_dir = settings.data_dir
+    settings.data_dir = str(tmp_path)
+    try:
+        for name, weights in WEIGHTS.items():
+            index = load_index(name)
+            # memory mapped, equal to the index built from the database
+            assert isinstance(index.starts.base, np.memmap)
+            expected = build_index(open_data(str(out_dir / f"{name}.npy")), weights)
+            assert all(np.array_equal(a, b) for a, b in zip(index, expected))
+
+        res = annotate([["chr1", 1, 30, "DEL"], ["chr3", 2, 3, "DUP"]])
+        assert res.gencode_genes.tolist() == [1, 0] and res.regulatory.tolist() == [0, 1]
+    finally:
+        settings.data_dir = data_dir
+
+
+def test_convert_json(tmp_path):
+    from isv import annotate, settings
+    from isv.annotate import WEIGHTS, load_databases, clear_databases
+
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    expected = annotate(bed.copy())
+
+    data_dir = settings.data_dir
+    shutil.copytree(pathlib.Path(data_dir) / "preprocessed", tmp_path / "preprocessed",
+                    ignore=shutil.ignore_patterns("*.npy", "*.index", "manifest.json"))
+    settings.data_dir = str(tmp_path)
+    try:
+        assert sorted(build_databases(from_json=True)) == sorted(WEIGHTS)
+        assert build_databases(from_json=True) == []
+
+        # shipped databases are memory mapped after the conversion
+        clear_databases()
+        assert all(isinstance(index.starts.base, np.memmap) for index in load_databases())
+        pd.testing.assert_frame_equal(annotate(bed.copy()), expected)
+    finally:
+        settings.data_dir = data_dir
+        clear_databases()
@@ -0,0 +1,46 @@
+import pathlib
+import sys
+
+import pandas as pd
+import pytest
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from isv import isv
+from isv_cmd import read_input, ResultWriter
+
+
+def test_columnar_round_trip(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    pq.write_table(pa.Table.from_pandas(bed, preserve_index=False), tmp_path / "cnvs.parquet")
+    expected = isv(bed, proba=False)
+
+    for extension in [".parquet", ".feather"]:
+        table = read_input(str(tmp_path / "cnvs.parquet"))
+        output = str(tmp_path / f"results{extension}")
+        with ResultWriter(output) as writer:
+            for chunk in read_input(str(tmp_path / "cnvs.parquet"), chunksize=20):
+                writer.write(isv(chunk, proba=False))
+
+        res = read_input(output).to_pandas()
+        assert table.num_rows == len(res)
+        assert res.ISV.dtype == "category"
+        assert (res.ISV.astype(str).values == expected.ISV.values).all()
+
+
+def test_tsv_flush(tmp_path):
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    output = str(tmp_path / "results.tsv")
+
+    with ResultWriter(output) as writer:
+        writer.write(isv(bed.iloc[:10], proba=True))
+        # the first chunk is on disk before the writer is closed
+        assert len(pd.read_csv(output, sep='\t')) == 10
+        writer.write(isv(bed.iloc[10:], proba=True).reset_index(drop=True))
+
+    assert len(pd.read_csv(output, sep='\t')) == len(bed)
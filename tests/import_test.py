@@ -0,0 +1,33 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+root_dir = '/'.join(filepath_list[:ind])
+
+# heavy dependencies only needed for shap values, plots, retraining or predictions
+LAZY_MODULES = ['xgboost', 'shap', 'plotly', 'sklearn', 'sklearn_json']
+
+# import time budget in seconds
+IMPORT_TIME_BUDGET = 5
+
+
+def test_import_time():
+    code = ("import json, sys, time; t = time.perf_counter(); import isv; "
+            "print(json.dumps({'time': time.perf_counter() - t, 'modules': sorted(sys.modules)}))")
+    out = subprocess.run([sys.executable, '-c', code], cwd=root_dir, capture_output=True, text=True, check=True)
+    res = json.loads(out.stdout.strip().split('\n')[-1])
+
+    assert [m for m in LAZY_MODULES if m in res['modules']] == []
+    assert res['time'] < IMPORT_TIME_BUDGET, f"import isv took {res['time']:.2f} s"
+
+
+def test_numba_backend_without_xgboost():
+    code = ("import json, sys; import isv; isv.settings.predict_backend = 'numba'; "
+            "isv.isv([['chr1', 1000000, 2000000, 'DEL'], ['chr2', 1000000, 2000000, 'DUP']]); "
+            "print(json.dumps(sorted(sys.modules)))")
+    out = subprocess.run([sys.executable, '-c', code], cwd=root_dir, capture_output=True, text=True, check=True)
+
+    assert 'xgboost' not in json.loads(out.stdout.strip().split('\n')[-1])
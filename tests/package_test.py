@@ -1,12 +1,23 @@
 import sys
+import time
 import pathlib
+import numpy as np
 import pandas as pd
+import pytest
 
 filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
 ind = filepath_list.index('tests')
 sys.path.insert(1, '/'.join(filepath_list[:ind]))
 
-from isv import isv, ISV
+from isv import isv, ISV, preload, clear_cache, enable_result_cache, disable_result_cache, \
+    profile
+from isv.predict import predict
+from isv.report import waterfall_data
+from isv.scripts.open_model import _load_model
+from isv.scripts.parallel import get_pool
+from isv.shap_vals import load_explainer
+from isv.scripts.prepare_df import prepare
+from isv.scripts.constants import LOSS_ATTRIBUTES, GAIN_ATTRIBUTES
 
 
 cnvs = [['chrX', 50000, 10000, "DEL"], ["chr7", 50, 600000, "DUP"]]
@@ -25,3 +36,177 @@ def test_isv_class():
 
     p = isv_cnvs.predict()
     s = isv_cnvs.shap()
+
+    # coordinates are not copied
+    assert np.shares_memory(p.start.values, isv_cnvs.cnvs.start.values)
+
+
+def test_database_cache():
+    preload()
+    p = ISV(cnvs).predict()
+    clear_cache()
+
+    assert p.ISV.values.tolist() == ISV(cnvs).predict().ISV.values.tolist()
+
+
+def test_isv_n_jobs():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    assert ISV(bed.copy()).predict().equals(ISV(bed.copy(), n_jobs=2).predict())
+
+
+def model_loads(_):
+    return _load_model.cache_info().misses
+
+
+def test_persistent_pool():
+    annotated = ISV(pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')).annotated
+    expected = predict(annotated)
+    start = time.perf_counter()
+    predict(annotated)
+    single = time.perf_counter() - start
+
+    # workers are started and load models on the first call only
+    predict(annotated, n_jobs=2)
+    pool = get_pool(2)
+    start = time.perf_counter()
+    for _ in range(3):
+        assert np.array_equal(predict(annotated, n_jobs=2), expected)
+    assert (time.perf_counter() - start) / 3 < 10 * single + 0.5
+
+    assert get_pool(2) is pool
+    assert max(pool.map(model_loads, range(8))) == 2
+
+
+def test_result_cache(tmp_path):
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    expected = isv(bed.copy(), shap=True, shap_background="sample")
+
+    enable_result_cache(str(tmp_path / "results.sqlite"))
+    try:
+        isv(bed.iloc[::2].copy(), shap=True, shap_background="sample")
+        # on-disk tier only
+        enable_result_cache(str(tmp_path / "results.sqlite"), memory_size=0)
+        res = isv(bed.copy(), shap=True, shap_background="sample")
+    finally:
+        disable_result_cache()
+
+    pd.testing.assert_frame_equal(expected, res)
+
+
+def test_profile():
+    with profile() as p:
+        ISV(cnvs).predict()
+
+    res = p.to_dict()
+    assert {"annotate", "scale", "predict"} <= set(res["stages"])
+    assert res["counters"]["cnvs_annotated"] == res["counters"]["cnvs_predicted"] == len(cnvs)
+
+
+def test_arrow_input():
+    pa = pytest.importorskip("pyarrow")
+
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    res = ISV(pa.Table.from_pandas(bed)).predict()
+
+    assert res.ISV.equals(ISV(bed).predict().ISV)
+
+
+def test_numba_backend():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    isv_cnvs = ISV(bed)
+
+    assert isv_cnvs.predict(backend="numba").ISV.equals(isv_cnvs.predict(backend="xgboost").ISV)
+
+
+def test_waterfall_report(tmp_path):
+    isv_cnvs = ISV(cnvs)
+
+    page = isv_cnvs.waterfall_report(str(tmp_path / "report.html"), background="sample")
+    files = isv_cnvs.waterfall_report(str(tmp_path / "report"), background="sample")
+
+    with open(page[0]) as f:
+        assert f.read().count("plotly.js v") == 1
+    assert len(files) == len(cnvs)
+    assert (tmp_path / "report" / "plotly.min.js").exists()
+
+
+def test_waterfall_base_value():
+    isv_cnvs = ISV(cnvs)
+    p = isv_cnvs.predict().ISV.values
+
+    for method in ["exact", "xgboost", "approximate"]:
+        data = waterfall_data(isv_cnvs, background="sample", method=method)
+        expected = p
+        if method == "exact":
+            # shap evaluates boosters only up to their best iteration
+            expected = [load_explainer(t, "sample").model.predict(prepare(isv_cnvs.annotated.iloc[[i]], t))[0]
+                        for i, t in enumerate(["loss", "gain"])]
+        # waterfalls end at predictions
+        assert np.allclose(data.base_value + data.shap_values.apply(np.sum), expected, atol=1e-5)
+
+        fig = isv_cnvs.waterfall(1, return_fig=True, background="sample", method=method)
+        assert np.isclose(fig.data[0].base, data.base_value[1])
+
+
+def test_selective_shap():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    isv_cnvs = ISV(bed)
+    p = isv_cnvs.predict().ISV.values
+    uncertain = (p > 0.05) & (p < 0.95)
+
+    full = isv_cnvs.shap(isv_cnvs.annotated, background="sample")
+    selected = isv_cnvs.shap(isv_cnvs.annotated, background="sample", proba_range=(0.05, 0.95))
+
+    assert selected[uncertain].equals(full[uncertain])
+    assert selected[~uncertain].isna().all().all()
+
+
+def test_approximate_shap():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    isv_cnvs = ISV(bed)
+    sv = isv_cnvs.shap(isv_cnvs.annotated, method="approximate")
+
+    # contributions sum to predictions minus a base probability per cnv type
+    base = sv.sum(axis=1) - isv_cnvs.predict().ISV
+    assert base.groupby(bed.cnv_type).std().max() < 1e-6
+
+
+def test_xgboost_shap():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t')
+    isv_cnvs = ISV(bed)
+    p = isv_cnvs.predict().ISV
+    sv = isv_cnvs.shap(isv_cnvs.annotated, method="xgboost")
+    log_odds = isv_cnvs.shap(isv_cnvs.annotated, method="xgboost", output="log_odds")
+
+    assert log_odds.columns.str.startswith("SHAP_LOG_ODDS_").all()
+    # both sum to predictions minus a base value per cnv type
+    assert (sv.sum(axis=1) - p).groupby(bed.cnv_type).std().max() < 1e-6
+    assert (log_odds.sum(axis=1) - np.log(p / (1 - p))).groupby(bed.cnv_type).std().max() < 1e-4
+
+
+def test_breakpoint_sensitivity():
+    bed = pd.read_csv('examples/loss_gain_cnvs.bed', sep='\t').iloc[:4]
+    isv_cnvs = ISV(bed)
+
+    res = isv_cnvs.sensitivity(0, 0)
+    assert (res.n_vectors == 1).all() and res.stable.all()
+    assert np.allclose(res.ISV_min, isv_cnvs.predict().ISV) and np.allclose(res.ISV_max, res.ISV_min)
+
+    # inverted coordinates, as annotated by annotate
+    inverted = ISV(cnvs)
+    res = inverted.sensitivity(0, 0)
+    assert np.allclose(res.ISV_min, inverted.predict().ISV) and (res.n_vectors == 1).all()
+    with pytest.raises(ValueError):
+        inverted.sensitivity(100, 100)
+
+    # every perturbed cnv is within the reported range
+    res = isv_cnvs.sensitivity(300, (-300, 0))
+    for i, cnv in bed.iterrows():
+        perturbed = [[cnv.iloc[0], cnv.iloc[1] + a, cnv.iloc[2] + b, cnv.iloc[3]]
+                     for a in range(-300, 301, 20) for b in range(-300, 1, 20)]
+        perturbed = ISV(perturbed)
+        p = perturbed.predict().ISV
+        assert res.ISV_min[i] - 1e-9 <= p.min() and p.max() <= res.ISV_max[i] + 1e-9
+        # distinct model inputs on the grid are a subset of the enumerated ones
+        attributes = LOSS_ATTRIBUTES if cnv.iloc[3] == "DEL" else GAIN_ATTRIBUTES
+        assert len(perturbed.annotated[attributes].drop_duplicates()) <= res.n_vectors[i]
@@ -0,0 +1,25 @@
+import pathlib
+import sys
+
+import numpy as np
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from isv import ISV
+from isv.scan import scan
+
+
+def test_scan():
+    track = scan([300000, 1000000], 250000, chromosomes=["chr21", "chrY"])
+
+    assert track.start.dtype == np.int32 and track.ISV_loss.dtype == np.float32
+    assert (track.end - track.start + 1).isin([300000, 1000000]).all()
+    assert track.start.min() == 1
+
+    for cnv_type, column in [("DEL", "ISV_loss"), ("DUP", "ISV_gain")]:
+        cnvs = track[["chrom", "start", "end"]].astype({"chrom": str})
+        cnvs["cnv_type"] = cnv_type
+        expected = ISV(cnvs).predict().ISV.values.astype(np.float32)
+        assert (track[column].values == expected).all()
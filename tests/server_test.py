@@ -0,0 +1,54 @@
+import asyncio
+import json
+import pathlib
+import sys
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+filepath_list = str(pathlib.Path(__file__).parent.absolute()).split('/')
+ind = filepath_list.index('tests')
+sys.path.insert(1, '/'.join(filepath_list[:ind]))
+
+from isv import isv
+from isv.server import ISVServer
+
+cnvs = [['chrX', 50000, 10000, "DEL"], ["chr7", 50, 600000, "DUP"], ["chr1", 1000000, 3000000, "DEL"]]
+
+
+def request(port, path, payload=None):
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', data=data) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server():
+    isv_server = ISVServer(window=0.5, shap=False)
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(isv_server.start(port=0), loop).result()
+    port = server.sockets[0].getsockname()[1]
+
+    try:
+        with ThreadPoolExecutor(len(cnvs)) as pool:
+            responses = list(pool.map(lambda cnv: request(port, '/predict', {'cnvs': [cnv]}), cnvs))
+
+        expected = isv(cnvs).ISV.values.tolist()
+        assert [r[0] for r in responses] == [200] * len(cnvs)
+        assert [r[1]['results'][0]['ISV'] for r in responses] == expected
+
+        status, res = request(port, '/predict', {'cnvs': cnvs, 'proba': False})
+        assert status == 200 and len(res['results']) == len(cnvs)
+
+        assert request(port, '/predict', {'cnvs': [['chr99', 1, 2, 'DEL']]})[0] == 400
+
+        status, metrics = request(port, '/metrics')
+        assert status == 200
+        assert metrics['endpoints']['/predict']['requests'] == len(cnvs) + 2
+        assert metrics['endpoints']['/predict']['batches'] < len(cnvs) + 1
+    finally:
+        loop.call_soon_threadsafe(server.close)